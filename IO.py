@@ -48,10 +48,10 @@ class IO:
 
 	def read_analog(self, channel):
 		data = lsampl_t()
-		reval = comedi_data_read(self.it_g, channel >> 8, channel & 0xff, 0, AREF_GROUND, byref(data))
+		retval = comedi_data_read(self.it_g, channel >> 8, channel & 0xff, 0, AREF_GROUND, byref(data))
 		if retval < 0:
 			raise IOException("Could not read from analog channel %d" % channel)
-		return data
+		return data.value
 
 io = IO()
 
@@ -0,0 +1,35 @@
+"""
+Monotonic clock for measuring intervals, unaffected by NTP or manual changes of the wall clock
+"""
+import ctypes
+import ctypes.util
+import os
+import time
+
+CLOCK_MONOTONIC = 1
+
+
+class timespec(ctypes.Structure):
+	_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+try:
+	_librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno=True)
+	_clock_gettime = _librt.clock_gettime
+	_clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+	_clock_gettime.restype = ctypes.c_int
+except (OSError, AttributeError):
+	_clock_gettime = None
+
+
+def monotonic():
+	"""
+	Seconds since an arbitrary fixed point, never going backwards
+	@return seconds (float)
+	"""
+	if _clock_gettime is None:
+		return time.time()
+	t = timespec()
+	if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+		errno = ctypes.get_errno()
+		raise OSError(errno, os.strerror(errno))
+	return t.tv_sec + t.tv_nsec * 1e-9
@@ -6,11 +6,19 @@ NUM_FLOORS = 4
 MCAST_GROUP = "224.1.1.1"
 MCAST_PORT = 5007
 
-# Time the door should open for clients to go in
+# Time the door should open for clients to go in, when nothing better is known
 DOOR_OPEN_SECONDS = 3
 
-# Parameters for tuning the cost function
-FLOOR_WEIGHT = 1
+# The door dwell is chosen per stop: short when passengers only leave, long enough for the passengers
+# usually boarding in the floor (times a margin) at hall calls, shortened when other calls are waiting
+DOOR_CAR_CALL_SECONDS = 2
+DOOR_HALL_CALL_SECONDS = 3
+DOOR_BOARDING_MARGIN = 1.5
+DOOR_BUSY_FACTOR = 0.75
+DOOR_MIN_SECONDS = 1
+DOOR_MAX_SECONDS = 8
+
+# Parameters for tuning the cost function, in seconds added to the predicted arrival time
 ORDER_WEIGHT = 2
 DIRECTION_WEIGHT = 5
 
@@ -20,11 +28,106 @@ TIMEOUT_LIMIT = 0.5
 # For how many heartbeats it should send an order
 BROADCAST_HEARTBEATS = 3
 
+# Send heartbeats as JSON instead of the binary format, for reading them with a packet sniffer
+WIRE_DEBUG_JSON = False
+
+# How often the full state is sent when it does not change, the heartbeats between are keepalives
+FULL_STATE_SECONDS = 1.0
+
+# How long an elevator waits before asking the same elevator for its full state again
+RESYNC_HOLDOFF_SECONDS = 0.1
+
+# Receive buffer of the socket in bytes, room for a backlog of heartbeats from many elevators (0 keeps the default)
+RECV_BUFFER_BYTES = 0
+
+# Most datagrams the receiver handles in one go before letting the event loop run other callbacks
+RECV_BATCH_LIMIT = 64
+
+# Largest datagram the sender builds, below the Ethernet MTU less the IP and UDP headers
+# (at most wire.RECV_BYTES, the receive buffer)
+MAX_DATAGRAM_BYTES = 1400
+
 # The frequency of sending heartbeats
 HEARTBEAT_FREQUENCY = 100.0 #Keep as a float
 
 # Speed of the elevator
 SPEED = 300
 
+# Rough time it takes to travel one floor at SPEED, used to estimate the position between sensors
+FLOOR_TRAVEL_SECONDS = 2.0
+
+# Step of the position in the heartbeat state, in floors. The state version is only bumped when a moving car
+# crosses a step, the other elevators extrapolate the position from the velocity in between
+POSITION_STEP_FLOORS = 0.25
+
+# Dispatch mode at startup (0: every elevator serves every floor, 1: zoning, 2: up-peak),
+# switched at runtime by sending SIGUSR1 to any elevator
+DISPATCH_MODE = 0
+
+# The main entrance, served by every zone and where up-peak batching happens
+LOBBY_FLOOR = 0
+
+# In up-peak mode, how long a car is held in the lobby, and how many car calls fill it early
+LOBBY_HOLD_SECONDS = 10
+LOBBY_BATCH_CALLS = 3
+
+# Analog channel of the load cell (-1 simulates the load from the stops instead)
+LOAD_CHANNEL = -1
+LOAD_FULL_SCALE = 4095.0
+
+# Share of the capacity from which the car takes no more hall calls
+LOAD_FULL_THRESHOLD = 0.8
+
+# Passengers in a full car, and how many board at every hall call when the load is simulated
+CAR_CAPACITY = 8
+SIM_PASSENGERS_PER_HALL_CALL = 2
+
+# How long an elevator waits idle before moving to its parking floor
+PARK_DELAY_SECONDS = 5
+
+# How long an elevator announces its parking floor before moving there, so the other elevators see the claim
+PARK_CLAIM_SECONDS = 0.1
+
+# How fast old hall calls are forgotten when choosing parking floors
+DEMAND_HALF_LIFE_SECONDS = 7*24*3600.0
+
+# How old a snapshot may be for the elevator to resume from it without a homing run
+SNAPSHOT_MAX_AGE_SECONDS = 60
+
+# How the inner orders and the car snapshot are persisted: 'journal' (order journal and a snapshot file)
+# or 'mmap' (one memory-mapped state file, for slow flash)
+PERSISTENCE = 'journal'
+
+# How often the memory-mapped state file is synced to disk
+STATEFILE_SYNC_SECONDS = 1.0
+
+# How long an order may wait before the car turns towards it, and before new calls go to other elevators
+MAX_WAIT_SECONDS = 60
+
+# How many served hall calls the wait percentiles are taken over
+WAIT_HISTORY = 200
+
+# How often the wait percentiles are printed (0 disables)
+WAIT_STATS_SECONDS = 0
+
+# How many order changes the OrderQueue keeps for changes_since
+ORDER_CHANGE_HISTORY = 64
+
+# How long the order journal collects records before writing them with one fsync
+JOURNAL_COMMIT_SECONDS = 0.05
+
+# How many journal records are written before they are compacted into a checkpoint
+JOURNAL_COMPACT_RECORDS = 256
+
+# How long shutdown may spend running the pending callbacks and writing the backups
+SHUTDOWN_DRAIN_SECONDS = 0.2
+
+# How many copies of the last heartbeat are sent when shutting down
+LEAVING_HEARTBEATS = 3
+
 # How long the sender should sleep before trying to reconnect to the system
-RECONNECT_SECONDS = 5
\ No newline at end of file
+RECONNECT_SECONDS = 5
+
+# How often the event loop prints thread count, context switches and event latency, and the sender
+# the press to broadcast latency of new orders and the receiver its batches and drops (0 disables)
+LOOP_STATS_SECONDS = 0
\ No newline at end of file
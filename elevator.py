@@ -3,11 +3,24 @@ from channels import INPUT, OUTPUT
 from functools import partial
 from IO import io
 import config
-from models import OrderQueue, Order, DoorTimer, ORDERDIR
+from models import Order, DoorTimer, ORDERDIR, ORDERCHANGE
 from time import sleep
 from networkhandler import NetworkHandler
-from threading import active_count, current_thread
+from eventloop import EventLoop
+from zoning import DISPATCHMODE
+from load import CarLoad
+from snapshot import CarSnapshot
+from journal import OrderJournal
+from statefile import StateFile
+from position import PositionEstimator
+from travelmodel import TravelModel
+from clock import monotonic
 from Queue import Queue
+import signal
+import time
+
+# How long the motor is reversed to brake before it is switched off
+BRAKE_SECONDS = 0.01
 
 class Elevator:
 	def __init__(self):
@@ -18,22 +31,72 @@ class Elevator:
 		self.direction = OUTPUT.MOTOR_DOWN
 		self.moving = False
 		self.currentFloor = -1
-
-		self.orderQueue = OrderQueue.load_from_file()
-		self.callbackQueue = Queue()
+		self.parkingFloor = None
+		self.parkingTimer = None
+		self.batching = False
+		self.destinationCalls = {}
+		self.servedCarCall = False
+		self.servedHallCalls = 0
+		self.carLoad = CarLoad()
+		self.dwell = config.DOOR_OPEN_SECONDS
+		self.doorActivity = False
+		self.passengersWaiting = False
+		self.earlyCloseTimer = None
+		self.positionEstimator = PositionEstimator()
+		self.travelModel = TravelModel.load_from_file()
+		self.brakeTimer = None
+
+		self.loop = EventLoop()
+		self.orderJournal = None
+		self.stateFile = None
+		self.snapshotKey = None
+		self.snapshotTime = 0.0
+		if config.PERSISTENCE == 'mmap':
+			# The state file holds the inner orders as a part of the snapshot
+			self.stateFile = StateFile(self.loop)
+			snapshot = self.stateFile.recover()
+			self.orderQueue = snapshot.get_order_queue()
+		else:
+			# The journal is synced on every commit and holds the inner orders, the snapshot file is
+			# not synced and only gives the floor, direction and door for a warm start
+			self.orderJournal = OrderJournal(self.loop)
+			self.orderQueue = self.orderJournal.recover()
+			snapshot = CarSnapshot.load_from_file()
 		self.newOrderQueue = Queue()
 		self.startedOrderQueue = Queue()
-		self.signalPoller = SignalPoller(self.callbackQueue)
-		self.doorTimer = DoorTimer(self.close_door, self.callbackQueue)
+		self.signalPoller = SignalPoller(self.loop)
+		self.doorTimer = DoorTimer(self.close_door, self.loop)
 		self.initialize_lights()
+		self.orderQueue.subscribe(self.order_changed)
 		self.initialize_networkHandler()
 		self.update_and_send_elevator_info()
 		self.set_callbacks()
 		self.networkHandler.start()
 		self.signalPoller.start()
-		self.drive()
+		if not self.warm_start(snapshot):
+			self.drive()
 		self.run()
 
+	def warm_start(self, snapshot):
+		"""
+		Resumes from the snapshot without a homing run if it is fresh and the sensor of its floor agrees
+		@input snapshot
+		@return true if resumed
+		"""
+		if not snapshot.is_fresh() or not self.signalPoller.read_channel(INPUT.SENSORS[snapshot.floor]):
+			return False
+		print 'RESUMING IN FLOOR %d FROM SNAPSHOT' % snapshot.floor
+		self.currentFloor = snapshot.floor
+		self.direction = snapshot.direction
+		self.positionEstimator.sensor_edge(snapshot.floor)
+		self.set_floor_indicator_light()
+		if snapshot.doorOpen:
+			# Someone may be in the door, give them a full dwell
+			self.loop.call_soon(self.open_door)
+		else:
+			self.loop.call_soon(self.should_drive)
+		return True
+
 	def initialize_lights(self):
 		"""
 		Turn of all lights on the panel
@@ -50,7 +113,7 @@ class Elevator:
 		Initialize the networkhandler, pass along callbacks
 		"""
 		self.networkHandler = NetworkHandler(
-			self.callbackQueue,
+			self.loop,
 			self.received_order,
 			self.set_light_callback,
 			self.newOrderQueue,
@@ -65,19 +128,72 @@ class Elevator:
 		self.set_floor_callbacks()
 		self.set_button_callbacks()
 		self.set_stop_callback()
+		self.set_load_callback()
+		self.set_obstruction_callback()
+		signal.signal(signal.SIGUSR1, self.dispatch_mode_signal)
+		signal.signal(signal.SIGTERM, self.shutdown_signal)
+		signal.signal(signal.SIGINT, self.shutdown_signal)
 
 	def run(self):
 		""" 
-		Main thread - block while waiting on something to do 
-		"""
-		while not self.interrupt:
-			func = self.callbackQueue.get()
-			func()
-		self.stop_elevator()
+		Main thread - runs the event loop until stopped
+		"""
+		if config.LOOP_STATS_SECONDS:
+			self.loop.call_later(config.LOOP_STATS_SECONDS, self.loop.report_stats, config.LOOP_STATS_SECONDS)
+			self.loop.call_later(config.LOOP_STATS_SECONDS, self.networkHandler.networkSender.report_stats, config.LOOP_STATS_SECONDS)
+			self.loop.call_later(config.LOOP_STATS_SECONDS, self.networkHandler.networkReceiver.report_stats, config.LOOP_STATS_SECONDS)
+		if config.WAIT_STATS_SECONDS:
+			self.loop.call_later(config.WAIT_STATS_SECONDS, self.report_waits)
+		self.loop.call_later(config.SNAPSHOT_MAX_AGE_SECONDS / 2.0, self.refresh_snapshot)
+		self.loop.run_forever()
+		self.shutdown()
 
 	def stop(self):
 		""" Stops EVERYTHING """
 		self.interrupt = True
+		self.loop.stop()
+
+	def shutdown_signal(self, signum, frame):
+		"""
+		Signal handler, stopping the elevator on the event loop
+		@input signum, frame
+		"""
+		self.loop.call_soon(self.stop)
+
+	def shutdown(self):
+		"""
+		Runs after the loop stopped: stops taking input, runs the callbacks already pending,
+		stops the car, writes the backups, tells the other elevators it is leaving and cancels every timer
+		"""
+		self.signalPoller.stop()
+		self.networkHandler.networkReceiver.stop()
+		if not self.loop.drain(config.SHUTDOWN_DRAIN_SECONDS):
+			print 'SHUTDOWN: DROPPED PENDING CALLBACKS'
+		self.stop_elevator()
+		self.update_and_send_elevator_info()
+		(self.stateFile or self.orderJournal).commit()
+		if not self.loop.flush_executor(config.SHUTDOWN_DRAIN_SECONDS):
+			print 'SHUTDOWN: BACKUPS NOT WRITTEN IN TIME'
+		self.networkHandler.networkSender.send_leaving()
+		self.loop.cancel_timers()
+		# The loop is gone, so wait for the brake here
+		sleep(BRAKE_SECONDS)
+		self.release_brake()
+
+	def dispatch_mode_signal(self, signum, frame):
+		"""
+		Signal handler, switching to the next dispatch mode on the event loop
+		@input signum, frame
+		"""
+		self.loop.call_soon(self.next_dispatch_mode)
+
+	def next_dispatch_mode(self):
+		"""
+		Switches the whole bank to the next dispatch mode
+		"""
+		dispatchMode = self.networkHandler.dispatchMode
+		dispatchMode.set_mode((dispatchMode.mode + 1) % len(DISPATCHMODE.NAMES))
+		print 'DISPATCH MODE SET TO %s' % DISPATCHMODE.NAMES[dispatchMode.mode]
 
 	def lost_connection(self):
 		"""
@@ -88,6 +204,7 @@ class Elevator:
 				io.set_bit(light, 0)
 		if self.orderQueue.has_orders():
 			self.orderQueue.delete_all_orders(exclude=ORDERDIR.IN)
+		self.destinationCalls = {}
 
 
 
@@ -97,6 +214,23 @@ class Elevator:
 		"""
 		self.signalPoller.add_callback_to_channel(INPUT.STOP, self.stop)
 
+	def set_load_callback(self):
+		"""
+		Listen on the load cell, if the car has one
+		"""
+		if config.LOAD_CHANNEL != -1:
+			self.signalPoller.add_callback_to_analog_channel(config.LOAD_CHANNEL, self.load_measured_callback, config.LOAD_FULL_SCALE/100)
+
+	def load_measured_callback(self, value):
+		"""
+		Callback on new load cell reading
+		@input value
+		"""
+		wasFull = self.carLoad.is_full()
+		self.carLoad.measured(value)
+		if wasFull != self.carLoad.is_full():
+			self.update_and_send_elevator_info()
+
 	def set_floor_callbacks(self):
 		""" 
 		Set callbackon on floor changes 
@@ -137,11 +271,18 @@ class Elevator:
 		External orders come from NetworkHandler, internal from self
 		@input order
 		"""
-		if order.direction == ORDERDIR.IN:
-			self.set_button_light(order.floor, OUTPUT.IN_LIGHTS, 1)
-		else:
-			self.startedOrderQueue.put(order)
+		if order.direction != ORDERDIR.IN:
+			self.startedOrderQueue.put((order, monotonic()))
+		if order.destination is not None:
+			destinations = self.destinationCalls.setdefault((order.direction, order.floor), [])
+			if order.destination not in destinations:
+				destinations.append(order.destination)
+		self.cancel_parking()
 		self.orderQueue.add_order(order)
+		if self.batching and order.direction == ORDERDIR.IN and self.count_inner_orders() >= config.LOBBY_BATCH_CALLS:
+			# The car is full enough, leave the lobby after the usual dwell
+			self.batching = False
+			self.doorTimer.start()
 		self.update_and_send_elevator_info()
 		self.should_drive()
 
@@ -151,7 +292,10 @@ class Elevator:
 		Callback on floor is reached
 		@input floor
 		"""
+		now = monotonic()
 		self.currentFloor = floor
+		self.positionEstimator.sensor_edge(floor, now)
+		self.travelModel.sensor_edge(floor, now)
 		self.set_floor_indicator_light()
 		self.should_stop()
 
@@ -163,9 +307,20 @@ class Elevator:
 		"""
 		order = Order(orderdir, floor)
 		if order.direction == ORDERDIR.IN:
+			self.passenger_activity()
 			self.received_order(order)
 			return
-		self.newOrderQueue.put(order)
+		self.newOrderQueue.put((order, monotonic()))
+
+	def destination_call(self, origin, destination):
+		"""
+		Entry point for destination panels: a passenger in origin wants to go to destination.
+		The network decides which elevator takes the trip and tells the passenger.
+		The hall panels of the test rig have no destination input, so only the driver of a destination panel calls this
+		@input origin, destination
+		"""
+		if origin != destination:
+			self.newOrderQueue.put((Order.from_destination(origin, destination), monotonic()))
 
 	def set_light_callback(self, direction, floor, value):
 		"""
@@ -179,6 +334,15 @@ class Elevator:
 		self.set_button_light(floor, lights, value)
 
 
+	def order_changed(self, change):
+		"""
+		OrderQueue subscriber keeping the inner lamps in step with the inner orders
+		@input change (version, ORDERCHANGE, Order)
+		"""
+		version, kind, order = change
+		if order.direction == ORDERDIR.IN:
+			self.set_button_light(order.floor, OUTPUT.IN_LIGHTS, int(kind == ORDERCHANGE.ADDED))
+
 	def set_button_light(self, floor, lights, value):
 		"""
 		Sets a button light
@@ -191,15 +355,19 @@ class Elevator:
 		""" 
 		Returns the direction in which the elevator should move
 		"""
+		if self.parkingFloor is not None and not self.orderQueue.has_orders():
+			return OUTPUT.MOTOR_UP if self.parkingFloor > self.currentFloor else OUTPUT.MOTOR_DOWN
+		oldest = self.orderQueue.oldest_order()
+		if oldest is not None and self.currentFloor >= 0 and oldest[1].floor != self.currentFloor and monotonic() - oldest[0] > config.MAX_WAIT_SECONDS:
+			# The order has waited too long, the sweep turns towards it
+			return OUTPUT.MOTOR_UP if oldest[1].floor > self.currentFloor else OUTPUT.MOTOR_DOWN
 		if self.direction == OUTPUT.MOTOR_UP:
-			for floor in xrange(self.currentFloor+1, config.NUM_FLOORS):
-			   if self.orderQueue.has_order_in_floor(floor):
-					return OUTPUT.MOTOR_UP
+			if self.orderQueue.has_order_between(self.currentFloor+1, config.NUM_FLOORS-1):
+				return OUTPUT.MOTOR_UP
 			return OUTPUT.MOTOR_DOWN
 		else:
-			for floor in xrange(self.currentFloor-1, -1, -1):
-				if self.orderQueue.has_order_in_floor(floor):
-					return OUTPUT.MOTOR_DOWN
+			if self.orderQueue.has_order_between(0, self.currentFloor-1):
+				return OUTPUT.MOTOR_DOWN
 			return OUTPUT.MOTOR_UP
 		return OUTPUT.MOTOR_UP
 
@@ -207,14 +375,22 @@ class Elevator:
 		"""
 		Finding direction and starts the elevator
 		"""
+		if self.interrupt:
+			# Shutting down, the car stays where it is
+			return
+		if self.brakeTimer is not None:
+			self.brakeTimer.cancel()
+			self.brakeTimer = None
 		self.direction = self.find_direction()
 		io.set_bit(OUTPUT.MOTORDIR, self.direction)
 		io.write_analog(OUTPUT.MOTOR, 2048+4*abs(config.SPEED))
+		self.positionEstimator.motor_started(self.direction, config.SPEED)
+		self.travelModel.motor_started(self.currentFloor, monotonic())
 		self.moving = True
 
 	def stop_elevator(self):
 		""" 
-		Stops the elevator
+		Stops the elevator by reversing the motor, and switches it off BRAKE_SECONDS later
 		"""
 		if not self.moving:
 			return
@@ -223,23 +399,138 @@ class Elevator:
 		else:
 			io.set_bit(OUTPUT.MOTORDIR, OUTPUT.MOTOR_UP)
 
-		sleep(0.01)
-		io.write_analog(OUTPUT.MOTOR, 2048)
+		self.brakeTimer = self.loop.call_later(BRAKE_SECONDS, self.release_brake)
+		self.positionEstimator.motor_stopped()
+		self.travelModel.motor_stopped()
 		self.moving = False
 
+	def release_brake(self):
+		"""
+		Switches the motor off after braking
+		"""
+		self.brakeTimer = None
+		io.write_analog(OUTPUT.MOTOR, 2048)
+
 	def open_door(self):
 		"""
-		Opens door and fires a thread with callback in x seconds
+		Opens door and schedules the close after a dwell chosen for the stop
 		"""
-		self.set_button_light(self.currentFloor, OUTPUT.IN_LIGHTS, 0)
+		servedCarCall, servedHallCalls = self.servedCarCall, self.servedHallCalls
+		self.servedCarCall = False
+		self.servedHallCalls = 0
+		if self.doorTimer.is_finished:
+			self.doorActivity = False
+			self.passengersWaiting = False
+		self.passengersWaiting |= servedHallCalls > 0
 		io.set_bit(OUTPUT.DOOR_OPEN, 1)
-		self.doorTimer.start()
+		self.travelModel.door_opened(self.currentFloor, monotonic())
+		self.carLoad.door_opened(servedCarCall, servedHallCalls, self.count_inner_orders() + int(servedCarCall))
+		self.board_destination_calls()
+		if self.batching:
+			pass
+		elif self.networkHandler.dispatchMode.mode == DISPATCHMODE.UPPEAK and self.currentFloor == config.LOBBY_FLOOR:
+			# Hold the car in the lobby to fill it up
+			self.batching = True
+			self.doorTimer.start(config.LOBBY_HOLD_SECONDS)
+		else:
+			self.dwell = self.choose_dwell()
+			self.doorTimer.start(self.dwell)
+			self.schedule_early_close()
+		self.save_snapshot()
+
+	def choose_dwell(self):
+		"""
+		Chooses how long the door stays open: long enough for the passengers usually boarding in this floor
+		when someone called the elevator here, short when passengers only leave, and shorter when others wait
+		@return seconds
+		"""
+		if self.passengersWaiting:
+			dwell = max(config.DOOR_HALL_CALL_SECONDS, self.travelModel.boardingSeconds[self.currentFloor] * config.DOOR_BOARDING_MARGIN)
+		else:
+			dwell = config.DOOR_CAR_CALL_SECONDS
+		if self.orderQueue.has_orders():
+			dwell *= config.DOOR_BUSY_FACTOR
+		return min(max(dwell, config.DOOR_MIN_SECONDS), config.DOOR_MAX_SECONDS)
+
+	def schedule_early_close(self):
+		"""
+		Checks after DOOR_MIN_SECONDS whether the door can close before the dwell runs out
+		"""
+		if self.earlyCloseTimer is not None:
+			self.earlyCloseTimer.cancel()
+		self.earlyCloseTimer = self.loop.call_later(config.DOOR_MIN_SECONDS, self.early_close)
+
+	def early_close(self):
+		"""
+		Closes the door early when nobody was waiting to board, no obstruction or car button was seen,
+		the door is free and no other calls are waiting
+		"""
+		self.earlyCloseTimer = None
+		if self.doorTimer.is_finished or self.batching or self.passengersWaiting or self.doorActivity:
+			return
+		if self.orderQueue.has_orders() or self.door_obstructed():
+			return
+		self.doorTimer.finish()
+
+	def door_obstructed(self):
+		"""
+		Reads the obstruction sensor, which the callback only reports when it goes high
+		@return true, false
+		"""
+		return bool(self.signalPoller.read_channel(INPUT.OBSTRUCTION))
+
+	def set_obstruction_callback(self):
+		"""
+		Listen on the obstruction sensor
+		"""
+		self.signalPoller.add_callback_to_channel(INPUT.OBSTRUCTION, self.obstruction_callback)
+
+	def obstruction_callback(self):
+		"""
+		Callback on obstruction, keeping the door open for another dwell
+		"""
+		self.passenger_activity()
+		if not self.doorTimer.is_finished and not self.batching:
+			self.doorTimer.start(self.dwell)
+
+	def passenger_activity(self):
+		"""
+		Someone is moving through the door, so it must not close early
+		"""
+		if not self.doorTimer.is_finished:
+			self.doorActivity = True
+			self.travelModel.passenger_activity(monotonic())
+
+	def board_destination_calls(self):
+		"""
+		Once a destination call is served, its passenger is boarding, so the destination becomes a car call
+		"""
+		boarded = False
+		for direction in (ORDERDIR.UP, ORDERDIR.DOWN):
+			if self.orderQueue.has_order_in_floor_and_direction(direction, self.currentFloor):
+				continue
+			for destination in self.destinationCalls.pop((direction, self.currentFloor), []):
+				self.orderQueue.add_order(Order(ORDERDIR.IN, destination))
+				boarded = True
+		if boarded:
+			self.update_and_send_elevator_info()
 
 	def close_door(self):
 		"""
-		Closes door and checking if the elevator should drive
+		Closes door and checking if the elevator should drive. A door still obstructed stays open for another dwell
 		"""
+		if self.door_obstructed():
+			self.doorTimer.start(self.dwell)
+			self.passenger_activity()
+			return
 		io.set_bit(OUTPUT.DOOR_OPEN, 0)
+		self.batching = False
+		self.save_snapshot()
+		if self.earlyCloseTimer is not None:
+			self.earlyCloseTimer.cancel()
+			self.earlyCloseTimer = None
+		self.travelModel.door_closed(monotonic())
+		self.loop.run_in_executor(TravelModel.save_to_file, TravelModel.deserialize(self.travelModel.serialize()))
 		self.should_drive()
 
 	def should_stop(self):
@@ -248,13 +539,24 @@ class Elevator:
 		"""
 		newDirection = self.find_direction()
 		if not self.orderQueue.has_orders():
-			# After initial or if dead.
-			self.stop_elevator()
+			# After initial, if dead, or when arriving in the parking floor
+			if self.parkingFloor is None or self.parkingFloor == self.currentFloor:
+				self.parkingFloor = None
+				self.stop_elevator()
+				self.update_and_send_elevator_info()
+		elif self.carLoad.is_full() and self.direction == newDirection and not self.orderQueue.has_order_in_floor_and_direction(ORDERDIR.IN, self.currentFloor) and self.orderQueue.has_order_in_floor_and_direction(self.direction, self.currentFloor) and self.networkHandler.networkReceiver.has_room_elsewhere():
+			# Nobody can board a full car, hand the hall call back to the other elevators and drive on.
+			# When every car is full the call would come straight back, so the car keeps it and stops
+			self.orderQueue.delete_order_in_floor(self.direction, self.currentFloor)
+			for destination in self.destinationCalls.pop((self.direction, self.currentFloor), []) or [None]:
+				self.newOrderQueue.put((Order(self.direction, self.currentFloor, destination), monotonic()))
+			self.update_and_send_elevator_info()
+			self.should_stop()
 		elif self.orderQueue.has_order_in_floor_and_direction(self.direction, self.currentFloor) or self.orderQueue.has_order_in_floor_and_direction(ORDERDIR.IN, self.currentFloor):
 			# Elevator has order in same floor same direction
 			if self.direction != newDirection:
-				self.orderQueue.delete_order_in_floor(newDirection, self.currentFloor)
-			self.orderQueue.delete_order_in_floor(self.direction, self.currentFloor)
+				self.serve_orders_in_floor(newDirection)
+			self.serve_orders_in_floor(self.direction)
 			self.update_and_send_elevator_info()
 			self.stop_elevator()
 			self.open_door()
@@ -262,7 +564,7 @@ class Elevator:
 			# Elevator has no order further in its direction
 			if self.orderQueue.has_order_in_floor(self.currentFloor):
 				# It has an order in the opposite direction in the same floor
-				self.orderQueue.delete_order_in_floor(not self.direction, self.currentFloor)
+				self.serve_orders_in_floor(not self.direction)
 				self.update_and_send_elevator_info()
 				self.stop_elevator()
 				self.open_door()
@@ -278,18 +580,135 @@ class Elevator:
 		if not self.moving:
 			new_direction = self.find_direction()
 			if self.orderQueue.has_order_in_floor_and_direction(self.direction, self.currentFloor) or self.orderQueue.has_order_in_floor_and_direction(ORDERDIR.IN, self.currentFloor):
-				self.orderQueue.delete_order_in_floor(self.direction, self.currentFloor)
+				self.serve_orders_in_floor(self.direction)
 				self.open_door()
 			elif new_direction != self.direction and self.orderQueue.has_order_in_floor_and_direction(not self.direction, self.currentFloor):
-				self.orderQueue.delete_order_in_floor(not self.direction, self.currentFloor)
+				self.serve_orders_in_floor(not self.direction)
 				self.open_door()
 			elif self.orderQueue.has_orders() and not self.moving and self.doorTimer.is_finished:
 				self.drive()
+			elif self.doorTimer.is_finished:
+				self.schedule_parking()
 			self.update_and_send_elevator_info()
 
-	def update_and_send_elevator_info(self):
+	def serve_orders_in_floor(self, direction):
+		"""
+		Deletes the orders served in the current floor, remembering what kind of calls the stop serves
+		@input direction
+		"""
+		if self.orderQueue.has_order_in_floor_and_direction(ORDERDIR.IN, self.currentFloor):
+			self.servedCarCall = True
+		if self.orderQueue.has_order_in_floor_and_direction(direction, self.currentFloor):
+			self.servedHallCalls += 1
+		self.orderQueue.delete_order_in_floor(direction, self.currentFloor)
+
+	def count_inner_orders(self):
 		"""
-		Updates and sends a copy of its elevatorinfo to the networkHandler and saving orderQueue to file
+		Returns how many floors the passengers in the car have asked for
+		@return count
 		"""
-		self.networkHandler.networkSender.elevatorInfo = {'currentFloor': self.currentFloor, 'direction': self.find_direction(), 'orderQueue': self.orderQueue.get_copy()}
-		self.orderQueue.save_to_file()
\ No newline at end of file
+		return self.orderQueue.count_orders(ORDERDIR.IN)
+
+	def schedule_parking(self):
+		"""
+		Parks the elevator if it is still idle after PARK_DELAY_SECONDS
+		"""
+		self.cancel_parking()
+		self.parkingTimer = self.loop.call_later(config.PARK_DELAY_SECONDS, self.park)
+
+	def cancel_parking(self):
+		"""
+		Stops waiting to park, and stops heading for the parking floor
+		"""
+		if self.parkingTimer is not None:
+			self.parkingTimer.cancel()
+			self.parkingTimer = None
+		self.parkingFloor = None
+
+	def park(self):
+		"""
+		Claims a parking floor for an idle elevator in the heartbeat, and moves there after PARK_CLAIM_SECONDS
+		"""
+		self.parkingTimer = None
+		if self.moving or self.orderQueue.has_orders() or not self.doorTimer.is_finished or self.currentFloor < 0:
+			return
+		floor = self.networkHandler.networkReceiver.get_parking_floor()
+		if floor is None or floor == self.currentFloor:
+			return
+		self.parkingFloor = floor
+		self.update_and_send_elevator_info()
+		self.parkingTimer = self.loop.call_later(config.PARK_CLAIM_SECONDS, self.drive_to_parking)
+
+	def drive_to_parking(self):
+		"""
+		Moves to the claimed parking floor, or claims another one if an elevator with a lower IP claimed it as well
+		"""
+		self.parkingTimer = None
+		if self.parkingFloor is None or self.moving or self.orderQueue.has_orders() or not self.doorTimer.is_finished:
+			return
+		if self.networkHandler.networkReceiver.parking_conflict(self.parkingFloor):
+			self.parkingFloor = None
+			self.update_and_send_elevator_info()
+			self.park()
+			return
+		self.drive()
+		self.update_and_send_elevator_info()
+
+	def report_waits(self):
+		"""
+		Prints percentiles of the waits of the last served hall calls every WAIT_STATS_SECONDS
+		"""
+		waits = self.orderQueue.wait_percentiles()
+		if waits:
+			print 'WAITS: %d hall calls, p50 %.1f s p90 %.1f s p99 %.1f s, oldest pending %.1f s' % (
+				len(self.orderQueue.waits), waits[50], waits[90], waits[99], self.orderQueue.get_oldest_wait())
+		self.loop.call_later(config.WAIT_STATS_SECONDS, self.report_waits)
+
+	def update_and_send_elevator_info(self):
+		"""
+		Updates and sends a copy of its elevatorinfo to the networkHandler and journals the inner orders
+		"""
+		orderQueue = self.orderQueue.get_copy()
+		self.networkHandler.networkSender.elevatorInfo = {
+			'currentFloor': self.currentFloor,
+			'direction': self.find_direction(),
+			'orderQueue': orderQueue,
+			'positionEstimator': self.positionEstimator,
+			'travelModel': self.travelModel,
+			'parkingFloor': self.parkingFloor,
+			'destinations': [[floor, destination] for (_, floor), destinations in self.destinationCalls.items() for destination in destinations],
+			'load': self.carLoad.get_load()
+			}
+		if self.orderJournal:
+			self.orderJournal.record(self.orderQueue)
+		self.save_snapshot()
+
+	def refresh_snapshot(self):
+		"""
+		Saves the snapshot every half SNAPSHOT_MAX_AGE_SECONDS, so an idle elevator that restarts still resumes from it
+		"""
+		self.save_snapshot()
+		self.loop.call_later(config.SNAPSHOT_MAX_AGE_SECONDS / 2.0, self.refresh_snapshot)
+
+	def save_snapshot(self):
+		"""
+		Saving the state needed for a warm restart. With the journal the snapshot file is only rewritten
+		when the floor, direction or door changed, or when it is half way to SNAPSHOT_MAX_AGE_SECONDS
+		"""
+		now = time.time()
+		snapshot = CarSnapshot(
+			self.currentFloor,
+			self.direction,
+			not self.doorTimer.is_finished,
+			self.orderQueue.get_floors(ORDERDIR.IN),
+			now
+			)
+		if self.stateFile:
+			self.stateFile.write(snapshot)
+			return
+		key = (snapshot.floor, snapshot.direction, snapshot.doorOpen)
+		if key == self.snapshotKey and now - self.snapshotTime < config.SNAPSHOT_MAX_AGE_SECONDS / 2.0:
+			return
+		self.snapshotKey = key
+		self.snapshotTime = now
+		self.loop.run_in_executor(snapshot.save_to_file)
\ No newline at end of file
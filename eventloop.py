@@ -0,0 +1,255 @@
+from threading import Thread, Lock, Event, active_count
+from collections import deque
+from Queue import Queue
+from timerwheel import TimerWheel, TimerHandle
+from clock import monotonic
+import resource
+import select
+import errno
+import fcntl
+import os
+
+
+class Executor(Thread):
+	"""
+	Runs blocking calls (like writing files) in order on a single worker thread,
+	so they never stall the EventLoop
+	"""
+	def __init__(self):
+		super(Executor, self).__init__()
+		self.daemon = True
+		self.jobs = Queue()
+
+	def submit(self, func, *args):
+		"""
+		Queues a call for the worker thread
+		@input func, args
+		"""
+		self.jobs.put((func, args))
+
+	def flush(self, timeout):
+		"""
+		Waits until the calls queued so far have run
+		@input timeout
+		@return true if they all ran in time
+		"""
+		done = Event()
+		self.submit(done.set)
+		return done.wait(timeout)
+
+	def run(self):
+		""" Runs the queued calls until the main thread stops, a failing call does not stop the ones after it """
+		while True:
+			func, args = self.jobs.get()
+			try:
+				func(*args)
+			except Exception, e:
+				print 'EXECUTOR: %s FAILED: %s' % (getattr(func, '__name__', func), e)
+
+
+class EventLoop:
+	"""
+	Single threaded event loop hosting the control logic, the timers and the network I/O.
+	Other threads hand work to it with call_soon_threadsafe.
+	"""
+	def __init__(self):
+		"""
+		Initializing the loop and the pipe other threads use to wake it up
+		"""
+		self.running = False
+		self.ready = deque()
+		self.timers = TimerWheel(monotonic())
+		self.timerCount = 0
+		self.readers = {}
+		self.executor = None
+		self.wakeupLock = Lock()
+		self.wakeupRead, self.wakeupWrite = os.pipe()
+		for fd in (self.wakeupRead, self.wakeupWrite):
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		self.reset_latency()
+
+	def call_soon(self, callback, *args):
+		"""
+		Runs the callback on the next iteration. Only call from the loop thread.
+		@input callback, args
+		"""
+		self.ready.append((callback, args, None))
+
+	def call_soon_threadsafe(self, callback, *args):
+		"""
+		Runs the callback on the next iteration and wakes the loop up. Safe from any thread.
+		@input callback, args
+		"""
+		self.ready.append((callback, args, monotonic()))
+		with self.wakeupLock:
+			try:
+				os.write(self.wakeupWrite, '\0')
+			except OSError, e:
+				# A full pipe means the loop is already woken up
+				if e.errno != errno.EAGAIN:
+					raise
+
+	def call_later(self, delay, callback, *args):
+		"""
+		Runs the callback after delay seconds. Only call from the loop thread.
+		@input delay, callback, args
+		@return TimerHandle
+		"""
+		self.timerCount += 1
+		handle = TimerHandle(monotonic() + delay, callback, args, self.timerCount)
+		self.timers.schedule(handle)
+		return handle
+
+	def add_reader(self, fileobj, callback):
+		"""
+		Runs the callback whenever the file object is readable
+		@input fileobj, callback
+		"""
+		self.readers[fileobj.fileno()] = callback
+
+	def remove_reader(self, fileobj):
+		"""
+		Stops watching the file object
+		@input fileobj
+		"""
+		self.readers.pop(fileobj.fileno(), None)
+
+	def run_in_executor(self, func, *args):
+		"""
+		Runs a blocking call on the worker thread
+		@input func, args
+		"""
+		if self.executor is None:
+			self.executor = Executor()
+			self.executor.start()
+		self.executor.submit(func, *args)
+
+	def get_timeout(self):
+		"""
+		Returns how long select may block before something has to run
+		@return seconds (None blocks until woken up)
+		"""
+		if self.ready:
+			return 0
+		deadline = self.timers.next_deadline()
+		if deadline is None:
+			return None
+		return max(0, deadline - monotonic())
+
+	def run_once(self):
+		"""
+		Waits for I/O or the next timer, then runs everything that is due
+		"""
+		try:
+			readable, _, _ = select.select([self.wakeupRead] + self.readers.keys(), [], [], self.get_timeout())
+		except select.error, e:
+			if e.args[0] != errno.EINTR:
+				raise
+			readable = []
+		for fd in readable:
+			if fd == self.wakeupRead:
+				self.drain_wakeup()
+			elif fd in self.readers:
+				self.readers[fd]()
+		now = monotonic()
+		for handle in self.timers.advance(now):
+			self.record_latency(now - handle.deadline)
+			self.ready.append((self.run_timer, (handle,), None))
+		for _ in xrange(len(self.ready)):
+			callback, args, enqueued = self.ready.popleft()
+			if enqueued is not None:
+				self.record_latency(monotonic() - enqueued)
+			callback(*args)
+
+	def run_timer(self, handle):
+		"""
+		Runs a due timer, unless an earlier callback of the same iteration cancelled it
+		@input handle (TimerHandle)
+		"""
+		if not handle.cancelled:
+			handle.callback(*handle.args)
+
+	def drain_wakeup(self):
+		""" Empties the wakeup pipe """
+		try:
+			while os.read(self.wakeupRead, 4096):
+				pass
+		except OSError, e:
+			if e.errno != errno.EAGAIN:
+				raise
+
+	def run_forever(self):
+		""" Runs the loop until stop is called """
+		self.running = True
+		while self.running:
+			self.run_once()
+
+	def stop(self):
+		""" Stops the loop after the current iteration """
+		self.running = False
+
+	def drain(self, timeout):
+		"""
+		Runs the callbacks already handed to the loop, without waiting for I/O or timers
+		@input timeout (seconds at most)
+		@return true if all of them ran
+		"""
+		deadline = monotonic() + timeout
+		while self.ready and monotonic() < deadline:
+			callback, args, _ = self.ready.popleft()
+			callback(*args)
+		return not self.ready
+
+	def flush_executor(self, timeout):
+		"""
+		Waits until the blocking calls handed to the executor have run
+		@input timeout
+		@return true if they all ran in time
+		"""
+		if self.executor is None:
+			return True
+		return self.executor.flush(timeout)
+
+	def cancel_timers(self):
+		""" Cancels every pending timer """
+		self.timers.cancel_all()
+
+	def record_latency(self, latency):
+		"""
+		Records how late an event ran compared to when it was due
+		@input latency
+		"""
+		self.eventCount += 1
+		self.totalLatency += latency
+		self.maxLatency = max(self.maxLatency, latency)
+
+	def reset_latency(self):
+		""" Starts a new measurement period """
+		self.eventCount = 0
+		self.totalLatency = 0.0
+		self.maxLatency = 0.0
+
+	def get_stats(self):
+		"""
+		Returns thread count, context switches and event latency since the last reset
+		@return dict
+		"""
+		usage = resource.getrusage(resource.RUSAGE_SELF)
+		return {
+			'threads': active_count(),
+			'contextSwitches': usage.ru_nvcsw + usage.ru_nivcsw,
+			'events': self.eventCount,
+			'meanLatency': self.totalLatency / self.eventCount if self.eventCount else 0.0,
+			'maxLatency': self.maxLatency
+			}
+
+	def report_stats(self, interval):
+		"""
+		Prints the stats every interval seconds
+		@input interval
+		"""
+		stats = self.get_stats()
+		print 'LOOP: %d threads, %d context switches, %d events, latency mean %.2f ms max %.2f ms' % (
+			stats['threads'], stats['contextSwitches'], stats['events'], stats['meanLatency']*1000, stats['maxLatency']*1000)
+		self.reset_latency()
+		self.call_later(interval, self.report_stats, interval)
@@ -0,0 +1,165 @@
+from os.path import isfile
+from zlib import crc32
+import os
+import json
+import config
+from models import OrderQueue, Order, ORDERDIR, ORDERCHANGE
+
+
+class OrderJournal:
+	"""
+	Persists the inner orders as an append-only journal of add and delete records on top of
+	a checkpoint. Records made close together share one write and one fsync, and the journal is
+	compacted into a new checkpoint when it grows long
+	"""
+	def __init__(self, loop, path='orderqueue.journal', checkpointPath='orderqueue.checkpoint'):
+		"""
+		@input loop (EventLoop running the commits), path, checkpointPath
+		"""
+		self.loop = loop
+		self.path = path
+		self.checkpointPath = checkpointPath
+		self.floors = set()
+		self.version = None
+		self.pending = []
+		self.commitTimer = None
+		self.records = 0
+		self.journal = None
+
+	@staticmethod
+	def encode(operation, floor):
+		"""
+		Encodes a record as a line with a checksum, so a torn write is detected on recovery
+		@input operation ('A' or 'D'), floor
+		@return line
+		"""
+		record = '%s %d' % (operation, floor)
+		return '%s %08x\n' % (record, crc32(record) & 0xffffffff)
+
+	@staticmethod
+	def decode(line):
+		"""
+		Decodes a record line
+		@input line
+		@return (operation, floor), None if the line is torn or corrupt
+		"""
+		if not line.endswith('\n'):
+			return None
+		try:
+			operation, floor, checksum = line.split()
+			if int(checksum, 16) != crc32('%s %s' % (operation, floor)) & 0xffffffff or operation not in 'AD':
+				return None
+			return operation, int(floor)
+		except ValueError:
+			return None
+
+	def recover(self):
+		"""
+		Reads the checkpoint and replays the journal on top of it. Replay stops at the first torn
+		record, and the journal is cut there before new records are appended
+		@return OrderQueue with the recovered inner orders
+		"""
+		if isfile(self.checkpointPath):
+			try:
+				with open(self.checkpointPath, 'r') as rfile:
+					self.floors = set(int(floor) for floor in json.load(rfile)['floors'])
+			except (ValueError, KeyError, TypeError):
+				print 'JOURNAL: CORRUPT CHECKPOINT'
+				self.floors = set()
+		elif isfile('orderqueue.backup'):
+			# Backup written before the journal existed, with a dense list of flags per direction
+			self.floors = set(floor for floor, ordered in enumerate(OrderQueue.load_from_file().orders[ORDERDIR.IN]) if ordered is True)
+
+		valid = 0
+		if isfile(self.path):
+			with open(self.path, 'r') as rfile:
+				for line in rfile:
+					record = self.decode(line)
+					if record is None:
+						print 'JOURNAL: TORN RECORD, REPLAY STOPPED'
+						break
+					operation, floor = record
+					if operation == 'A':
+						self.floors.add(floor)
+					else:
+						self.floors.discard(floor)
+					valid += len(line)
+					self.records += 1
+
+		self.journal = open(self.path, 'a+')
+		self.journal.truncate(valid)
+
+		orderQueue = OrderQueue()
+		for floor in self.floors:
+			if 0 <= floor < config.NUM_FLOORS:
+				orderQueue.add_order(Order(ORDERDIR.IN, floor))
+		return orderQueue
+
+	def record(self, orderQueue):
+		"""
+		Records the inner orders changed in orderQueue since the last call and schedules a group commit.
+		Compares every floor the first time and when the changes are no longer in its history
+		@input orderQueue
+		"""
+		changes = None if self.version is None else orderQueue.changes_since(self.version)
+		if changes is None:
+			for floor in xrange(config.NUM_FLOORS):
+				self.record_floor(floor, orderQueue.has_order_in_floor_and_direction(ORDERDIR.IN, floor))
+		else:
+			for version, kind, order in changes:
+				if order.direction == ORDERDIR.IN:
+					self.record_floor(order.floor, kind == ORDERCHANGE.ADDED)
+		self.version = orderQueue.version
+		if self.pending and self.commitTimer is None:
+			self.commitTimer = self.loop.call_later(config.JOURNAL_COMMIT_SECONDS, self.commit)
+
+	def record_floor(self, floor, ordered):
+		"""
+		Appends a record if the inner order in floor changed
+		@input floor, ordered
+		"""
+		if ordered and floor not in self.floors:
+			self.floors.add(floor)
+			self.pending.append(self.encode('A', floor))
+		elif not ordered and floor in self.floors:
+			self.floors.discard(floor)
+			self.pending.append(self.encode('D', floor))
+
+	def commit(self):
+		"""
+		Hands the pending records to the executor, which writes them with one fsync
+		"""
+		if self.commitTimer is not None:
+			self.commitTimer.cancel()
+			self.commitTimer = None
+		if not self.pending:
+			return
+		records, self.pending = self.pending, []
+		self.loop.run_in_executor(self.write, records, frozenset(self.floors))
+
+	def write(self, records, floors):
+		"""
+		Appends the records and syncs them to disk, compacting when the journal is long.
+		Runs on the executor thread
+		@input records (encoded lines), floors (inner orders after the records)
+		"""
+		self.journal.write(''.join(records))
+		self.journal.flush()
+		os.fsync(self.journal.fileno())
+		self.records += len(records)
+		if self.records >= config.JOURNAL_COMPACT_RECORDS:
+			self.compact(floors)
+
+	def compact(self, floors):
+		"""
+		Writes the floors to a new checkpoint and empties the journal. A crash between the rename
+		and the truncate only replays records the checkpoint already holds, which gives the same state
+		@input floors
+		"""
+		with open(self.checkpointPath + '.tmp', 'w') as wfile:
+			json.dump({'floors': sorted(floors)}, wfile)
+			wfile.flush()
+			os.fsync(wfile.fileno())
+		os.rename(self.checkpointPath + '.tmp', self.checkpointPath)
+		self.journal.truncate(0)
+		self.records = 0
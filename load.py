@@ -0,0 +1,45 @@
+import config
+
+
+class CarLoad:
+	"""
+	The share of the car capacity in use. Read from the load cell on LOAD_CHANNEL, or,
+	without one, simulated from the passengers boarding at hall calls and leaving at car calls.
+	"""
+	def __init__(self):
+		self.load = 0.0
+		self.simulated = config.LOAD_CHANNEL == -1
+		self.passengers = 0.0
+
+	def measured(self, value):
+		"""
+		Called with every new reading of the load cell
+		@input value (raw analog value)
+		"""
+		self.load = min(1.0, max(0.0, float(value) / config.LOAD_FULL_SCALE))
+
+	def door_opened(self, servedCarCall, servedHallCalls, carCalls):
+		"""
+		Simulates the passengers leaving and boarding when the door opens
+		@input servedCarCall (true if someone wanted to get off here), servedHallCalls (how many directions were called),
+		carCalls (how many floors the passengers want to go to, including this one)
+		"""
+		if not self.simulated:
+			return
+		if servedCarCall and carCalls:
+			self.passengers -= self.passengers / carCalls
+		self.passengers = min(config.CAR_CAPACITY, self.passengers + servedHallCalls * config.SIM_PASSENGERS_PER_HALL_CALL)
+		self.load = self.passengers / config.CAR_CAPACITY
+
+	def get_load(self):
+		"""
+		@return share of the capacity in use, from 0 to 1
+		"""
+		return self.load
+
+	def is_full(self):
+		"""
+		Returns if no more passengers fit in the car
+		@return true, false
+		"""
+		return self.load >= config.LOAD_FULL_THRESHOLD
@@ -1,8 +1,10 @@
 from IO import io
 from channels import INPUT, OUTPUT
-from threading import Timer
 import json
-from copy import deepcopy
+from collections import deque
+from clock import monotonic
+from bisect import bisect_left, insort
+import heapq
 import pickle
 from os.path import isfile
 import config
@@ -13,62 +15,138 @@ class ORDERDIR:
 	DOWN = 1
 	IN = 2
 
+class ORDERCHANGE:
+	ADDED = 0
+	REMOVED = 1
+
 class DoorTimer:
 	"""
-	Fires a thread that asks elevator to handle door closed in DOOR_OPEN_SECONDS seconds
+	Schedules a timer on the event loop that asks elevator to handle door closed after the dwell
 	"""
-	def __init__(self, callback, callbackQueue):
+	def __init__(self, callback, loop):
 		self.is_finished = True
 		self.callback = callback
-		self.callbackQueue = callbackQueue
-		self.set_timer()
-
-	def set_timer(self):
-		self.timer = Timer(config.DOOR_OPEN_SECONDS, self.set_finished)
+		self.loop = loop
+		self.timer = None
 
-	def start(self):
+	def start(self, seconds=None):
 		"""
 		If already started, cancel the job and start a new one
+		@input seconds (default DOOR_OPEN_SECONDS)
 		"""
 		if not self.is_finished:
 			self.timer.cancel()
-			self.set_timer()
 		self.is_finished = False
-		self.timer.start()
+		self.timer = self.loop.call_later(config.DOOR_OPEN_SECONDS if seconds is None else seconds, self.set_finished)
+
+	def finish(self):
+		"""
+		Runs out the timer now, closing the door early
+		"""
+		if not self.is_finished:
+			self.timer.cancel()
+			self.set_finished()
 
 	def set_finished(self):
 		self.is_finished = True
-		self.set_timer()
-		self.callbackQueue.put(self.callback)
+		self.timer = None
+		self.callback()
+
+
+
+def pack_order_id(direction, floor, destination=None):
+	"""
+	Packs an order into a collision-free integer: 2 bits of direction, 14 bits of floor,
+	and the destination plus one above them (0 without a destination)
+	@input direction, floor, destination (default None)
+	@return id
+	"""
+	return ((0 if destination is None else destination + 1) << 16) | (floor << 2) | direction
+
+
+class Order(object):
+	"""
+	Orders are immutable and interned, so there is only one Order per (direction, floor, destination)
+	and creating one in a hot path is a dictionary lookup
+	"""
+	__slots__ = ('direction', 'floor', 'destination', 'id')
+	interned = {}
 
+	def __new__(cls, direction, floor, destination=None):
+		"""
+		A hall call in a direction, a car call (ORDERDIR.IN), or with destination dispatch
+		a hall call carrying the floor the passenger wants to go to
+		@input direction, floor, destination (default None)
+		"""
+		direction = int(direction)
+		key = pack_order_id(direction, floor, destination)
+		order = Order.interned.get(key)
+		if order is None:
+			order = object.__new__(cls)
+			order.direction = direction
+			order.floor = floor
+			order.destination = destination
+			order.id = key
+			order = Order.interned.setdefault(key, order)
+		return order
 
+	@staticmethod
+	def from_id(id):
+		"""
+		Returns the order packed into an id
+		@input id
+		@return Order
+		"""
+		destination = (id >> 16) - 1
+		return Order(id & 0x03, (id >> 2) & 0x3fff, destination if destination >= 0 else None)
 
-class Order:
-	def __init__(self, direction, floor):
-		self.direction = direction
-		self.floor = floor
+	@staticmethod
+	def from_destination(origin, destination):
+		"""
+		Creating a destination call, the direction following from the trip
+		@input origin, destination
+		@return Order
+		"""
+		direction = ORDERDIR.UP if destination > origin else ORDERDIR.DOWN
+		return Order(direction, origin, destination)
 
 	def serialize(self):
-		return {'direction': self.direction, 'floor': self.floor, 'id': int('%s%s' % (self.floor, self.direction))}
+		return self.id
 
 	@staticmethod
-	def deserialize(object):
-		return Order(direction=object['direction'], floor=object['floor'])
+	def deserialize(id):
+		try:
+			return Order.from_id(int(id))
+		except (TypeError, ValueError):
+			raise ValueError("WRONG ORDER")
 
 	def __str__(self):
+		if self.destination is not None:
+			return "direction: %d, floor: %d, destination: %d" % (self.direction, self.floor, self.destination)
 		return "direction: %d, floor: %d" % (self.direction, self.floor)
 
 class OrderQueue:
 	def __init__(self, orders=None):
-		""" Initializing OrderQueue setting False in every order """
+		"""
+		Initializing OrderQueue setting False in every order. Every change bumps the version
+		and is kept as a (version, ORDERCHANGE, Order) delta for subscribers and changes_since.
+		The orders are kept sparse, as a sorted list of the ordered floors per direction.
+		Beside the orders it keeps when each was made (monotonic, per direction and floor), a heap of them
+		for finding the oldest, and the waits of the last served hall calls
+		"""
+		self.orders = {ORDERDIR.UP: [], ORDERDIR.DOWN: [], ORDERDIR.IN: []}
 		if orders:
-			self.orders = orders
-		else:
-			self.orders = {ORDERDIR.UP: [False] * config.NUM_FLOORS, ORDERDIR.DOWN: [False] * config.NUM_FLOORS, ORDERDIR.IN: [False] * config.NUM_FLOORS}
+			self.orders.update(orders)
+		self.version = 0
+		self.changes = deque(maxlen=config.ORDER_CHANGE_HISTORY)
+		self.subscribers = []
+		self.created = {ORDERDIR.UP: {}, ORDERDIR.DOWN: {}, ORDERDIR.IN: {}}
+		self.ageHeap = []
+		self.waits = deque(maxlen=config.WAIT_HISTORY)
 
 	def serialize(self):
 		"""
-		Serializing itself
+		Serializing itself, the size grows with the number of orders and not of floors
 		"""
 		return self.orders
 
@@ -80,39 +158,127 @@ class OrderQueue:
 		@return Object
 		"""
 		try:
-			return OrderQueue(orders={int(k):v for k, v in orders.items()})
+			return OrderQueue(orders={int(k):sorted(set(int(floor) for floor in v)) for k, v in orders.items()})
 		except:
 			raise ValueError("WRONG ORDERQUEUE")
 
 	def get_copy(self):
-		""" Returns a deep copy of itself """
-		return deepcopy(self)
+		""" Returns a copy of the orders and the version, without the change history and subscribers """
+		orderQueue = OrderQueue(orders={direction: list(floors) for direction, floors in self.orders.items()})
+		orderQueue.version = self.version
+		orderQueue.created = dict((direction, dict(created)) for direction, created in self.created.items())
+		orderQueue.ageHeap = list(self.ageHeap)
+		return orderQueue
+
+	def subscribe(self, callback):
+		"""
+		Calls callback with every (version, ORDERCHANGE, Order) delta from now on
+		@input callback
+		"""
+		self.subscribers.append(callback)
+
+	def unsubscribe(self, callback):
+		"""
+		Stops calling a callback passed to subscribe
+		@input callback
+		"""
+		self.subscribers.remove(callback)
+
+	def changes_since(self, version):
+		"""
+		Returns the deltas after a version
+		@input version
+		@return list of (version, ORDERCHANGE, Order), None if they are no longer in the history
+		"""
+		if version == self.version:
+			return []
+		if version > self.version or not self.changes or self.changes[0][0] > version + 1:
+			return None
+		return [change for change in self.changes if change[0] > version]
+
+	def changed(self, kind, direction, floor):
+		"""
+		Records a delta and hands it to the subscribers
+		@input kind (ORDERCHANGE), direction, floor
+		"""
+		self.version += 1
+		change = (self.version, kind, Order(direction, floor))
+		self.changes.append(change)
+		for callback in self.subscribers:
+			callback(change)
 
 	def has_orders(self):
 		""" 
 		Determines whether the queue has any orders
 		@return true, false
 		"""
-		for key, val in self.orders.items():
-			if True in val:
+		for floors in self.orders.values():
+			if floors:
 				return True
 		return False
 
-	def add_order(self, order):
+	def add_order(self, order, now=None):
 		"""
 		Adding order to OrderQueue
-		@input order (Order)
+		@input order (Order), now (default monotonic())
 		"""
-		self.orders[order.direction][order.floor] = True
+		if not self.has_order_in_floor_and_direction(order.direction, order.floor):
+			now = monotonic() if now is None else now
+			insort(self.orders[order.direction], order.floor)
+			self.created[order.direction][order.floor] = now
+			heapq.heappush(self.ageHeap, (now, order.direction, order.floor))
+			if len(self.ageHeap) > 4 * (self.count_orders() + 1):
+				# Drop the entries of served orders that never reached the top
+				self.ageHeap = [entry for entry in self.ageHeap if self.created[entry[1]].get(entry[2]) == entry[0]]
+				heapq.heapify(self.ageHeap)
+			self.changed(ORDERCHANGE.ADDED, order.direction, order.floor)
 
-	def delete_order_in_floor(self, direction, floor):
+	def delete_order_in_floor(self, direction, floor, now=None):
 		"""
-		Deleting an order in a certain floor
-		@input floor
+		Deleting the orders served in a certain floor, remembering how long the hall call waited
+		@input direction, floor, now (default monotonic())
 		"""
-		for _direction, floors in self.orders.items():
-			if _direction in (direction, ORDERDIR.IN):
-				floors[floor] = False
+		for _direction in (direction, ORDERDIR.IN):
+			if self.has_order_in_floor_and_direction(_direction, floor):
+				self.orders[_direction].remove(floor)
+				created = self.created[_direction].pop(floor, None)
+				if _direction != ORDERDIR.IN and created is not None:
+					self.waits.append((monotonic() if now is None else now) - created)
+				self.changed(ORDERCHANGE.REMOVED, _direction, floor)
+
+	def oldest_order(self):
+		"""
+		Returns the order waiting longest
+		@return (created, Order), None if there is no order with a known age
+		"""
+		while self.ageHeap:
+			created, direction, floor = self.ageHeap[0]
+			if self.created[direction].get(floor) == created:
+				return created, Order(direction, floor)
+			heapq.heappop(self.ageHeap)
+		return None
+
+	def get_oldest_wait(self, now=None):
+		"""
+		Returns how long the oldest order has waited
+		@input now (default monotonic())
+		@return seconds
+		"""
+		oldest = self.oldest_order()
+		if oldest is None:
+			return 0.0
+		return (monotonic() if now is None else now) - oldest[0]
+
+	def wait_percentiles(self, percentiles=(50, 90, 99)):
+		"""
+		Returns percentiles of the waits of the last served hall calls
+		@input percentiles
+		@return {percentile: seconds}, empty if no hall call is served yet
+		"""
+		waits = sorted(self.waits)
+		if not waits:
+			return {}
+		return dict((percentile, waits[min(len(waits) - 1, len(waits) * percentile // 100)]) for percentile in percentiles)
 
 	def has_order_in_floor_and_direction(self, direction, floor):
 		"""
@@ -120,18 +286,50 @@ class OrderQueue:
 		@input direction, floor
 		@return true, false
 		"""
-		return self.orders[direction][floor]
+		floors = self.orders[direction]
+		index = bisect_left(floors, floor)
+		return index < len(floors) and floors[index] == floor
 
 	def has_order_in_floor(self, floor):
 		"""
 		Returns if the queue has order in a floor and any direction
 		@return true, false
 		"""
-		for direction, floors in self.orders.items():
-			if floors[floor]:
+		for direction in self.orders:
+			if self.has_order_in_floor_and_direction(direction, floor):
+				return True
+		return False
+
+	def has_order_between(self, low, high):
+		"""
+		Returns if the queue has order in any direction in a floor from low to high, both included
+		@input low, high
+		@return true, false
+		"""
+		for floors in self.orders.values():
+			index = bisect_left(floors, low)
+			if index < len(floors) and floors[index] <= high:
 				return True
 		return False
 
+	def get_floors(self, direction):
+		"""
+		Returns the ordered floors in a direction
+		@input direction
+		@return sorted list of floors
+		"""
+		return list(self.orders[direction])
+
+	def count_orders(self, direction=None):
+		"""
+		Returns the number of orders, in one direction or in all
+		@input direction (default all)
+		@return count
+		"""
+		if direction is not None:
+			return len(self.orders[direction])
+		return sum(len(floors) for floors in self.orders.values())
+
 	def delete_all_orders(self, exclude=None):
 		"""
 		Deletes all orders
@@ -139,8 +337,10 @@ class OrderQueue:
 		for direction, floors in self.orders.items():
 			if direction == exclude:
 				continue
-			for floor in range(len(floors)):
-				floors[floor] = False
+			self.orders[direction] = []
+			self.created[direction] = {}
+			for floor in floors:
+				self.changed(ORDERCHANGE.REMOVED, direction, floor)
 
 	def yield_orders(self, exclude=(ORDERDIR.IN,)):
 		"""
@@ -150,32 +350,21 @@ class OrderQueue:
 		for direction, floors in self.orders.items():
 			if direction in exclude:
 				continue
-			for floor in range(len(floors)):
-				if floors[floor]:
-					yield Order(direction, floor)
+			for floor in floors:
+				yield Order(direction, floor)
 
 	def create_backup(self):
 		"""
 		Creates a backup of the elevator containing only the inner orders,
-		the rest is false
+		the rest is empty
 		@return OrderQueue
 		"""
-		orderQueue = self.get_copy()
-		for direction, floors in orderQueue.orders.items():
-			for floor in range(len(floors)):
-				if direction != ORDERDIR.IN and floors[floor]:
-					floors[floor] = False
-		return orderQueue
+		return OrderQueue(orders={ORDERDIR.IN: self.get_floors(ORDERDIR.IN)})
 
-	def save_to_file(self):
-		orderQueue = self.create_backup()
-		with open('orderqueue.backup', 'w+') as wfile:
-			pickle.dump(orderQueue, wfile)
-			
 	@staticmethod
 	def load_from_file():
 		"""
-		Loading from file and returning an OrderQueue
+		Loading the backup written before the order journal existed and returning an OrderQueue
 		"""
 		if not isfile('orderqueue.backup'):
 			return OrderQueue()
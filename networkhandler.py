@@ -1,62 +1,93 @@
-from threading import Thread, Timer
 import socket
-from time import sleep
+import os
 import struct
-import select
-import json
-from models import Order, OrderQueue, ORDERDIR
+import wire
+from models import Order, ORDERDIR
+from clock import monotonic
+from peerstate import PeerState
+from travelmodel import TravelModel
+from parking import DemandModel
+from zoning import DISPATCHMODE, DispatchMode, get_zones, in_zone
 from random import randint, choice
-from Queue import Queue
-from functools import partial
+from Queue import Queue, Empty
 from channels import INPUT, OUTPUT
-import time
+from time import sleep
+import heapq
+import errno
 import config
 
-class NetworkHandler(Thread):
+class NetworkHandler:
 	""" 
-	Handling all the network interaction. Receiving messages on its main thread, and spawns a listening thread
+	Handling all the network interaction. Both the receiver and the sender run on the event loop
 	"""
-	def __init__(self, callbackQueue, addOrderCallback, setLightCallback, newOrderQueue, startedOrderQueue, lostConnectionCallback, elevatorInfo=None):
-		super(NetworkHandler, self).__init__()
-		self.daemon = True
+	def __init__(self, loop, addOrderCallback, setLightCallback, newOrderQueue, startedOrderQueue, lostConnectionCallback, elevatorInfo=None):
+		self.dispatchMode = DispatchMode()
 		self.networkReceiver = NetworkReceiver(
-			callbackQueue,
+			loop,
 			addOrderCallback,
-			setLightCallback
+			setLightCallback,
+			self.dispatchMode
 			)
 
 		self.networkSender = NetworkSender(
 			elevatorInfo, 
 			newOrderQueue, 
-			callbackQueue,
+			loop,
 			startedOrderQueue, 
-			lostConnectionCallback
-			)	
+			lostConnectionCallback,
+			self.dispatchMode,
+			self.networkReceiver.nodeId
+			)
+		self.networkReceiver.resyncCallback = self.networkSender.request_full_state
 
-	def run(self):
+	def start(self):
 		"""
-		Spawns a senderthread and handling responses on its main thread
+		Starts sending heartbeats and listening for messages
 		"""
 		self.networkSender.start()
-		self.networkReceiver.serve_forever()
+		self.networkReceiver.start()
 
 class NetworkReceiver():
 
-	def __init__(self, callbackQueue, addOrderCallback, setLightCallback):
+	def __init__(self, loop, addOrderCallback, setLightCallback, dispatchMode):
 		"""
 		Initializing the networkreciever
 		"""
-		self.callbackQueue = callbackQueue
+		self.loop = loop
 		self.addOrderCallback = addOrderCallback
 		self.setLightCallback = setLightCallback
-		self.globalOrders = {ORDERDIR.DOWN: [False] * config.NUM_FLOORS, ORDERDIR.UP: [False] * config.NUM_FLOORS}
+		self.dispatchMode = dispatchMode
+		# How many elevators have each hall order, and the hall orders each elevator was counted with
+		self.globalOrders = {ORDERDIR.DOWN: {}, ORDERDIR.UP: {}}
+		self.hallFloors = {}
 		self.ip = self.get_ip()
+		self.nodeId = struct.unpack('!I', socket.inet_aton(self.ip))[0]
+		self.resyncCallback = None
+		self.sequences = {}
+		self.resyncRequested = {}
+		self.lostHeartbeats = 0
 		self.elevators = {}
+		self.travelModels = {}
+		# Heap of (deadline, ip), one entry per elevator, with its deadline in self.deadlines.
+		# Heartbeats only move the deadline of the elevator, and the entry is pushed back when it comes up early
+		self.deadlineHeap = []
+		self.deadlines = {}
+		self.timeoutTimer = None
 		self.startedOrders = {}
+		self.seenNewOrders = {}
+		self.demandModel = DemandModel()
 		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
 		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		mreq = struct.pack("4sl", socket.inet_aton(config.MCAST_GROUP), socket.INADDR_ANY)
 		self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+		if config.RECV_BUFFER_BYTES:
+			self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, config.RECV_BUFFER_BYTES)
+		# Datagrams are received into this buffer and decoded from views of it, without allocating
+		self.buffer = bytearray(wire.RECV_BYTES)
+		self.view = memoryview(self.buffer)
+		self.batches = 0
+		self.datagrams = 0
+		self.maxBatch = 0
 
 	def get_ip(self):
 		"""
@@ -68,41 +99,118 @@ class NetworkReceiver():
 		return s.getsockname()[0]
 
 
-	def serve_forever(self):
+	def start(self):
 		""" 
-		Binding to multicast and listening for messages without blocking 
+		Binding to multicast and listening for messages on the event loop without blocking 
 		"""
 		self.sock.bind(('', config.MCAST_PORT))
 		self.sock.setblocking(0)
-		while True:
-			r, _, _ = select.select([self.sock], [], [], 0.1)
-			if r:
-				self.handle_message(r[0].recvfrom(1024))
-			self.handle_timeouts()
-		self.sock.close()
+		self.loop.add_reader(self.sock, self.handle_readable)
 
-	def determine_cost(self, order, message):
+	def stop(self):
+		""" 
+		Stops listening for messages
 		"""
-		Determines the cost of an order based on the message from an elevator
-		@input order, message
+		self.loop.remove_reader(self.sock)
+		if self.timeoutTimer is not None:
+			self.timeoutTimer.cancel()
+			self.timeoutTimer = None
+
+	def handle_readable(self):
+		"""
+		Called by the event loop when a message is waiting on the socket.
+		Handles every waiting datagram, up to RECV_BATCH_LIMIT, so the backlog does not grow
+		"""
+		batch = 0
+		while batch < config.RECV_BATCH_LIMIT:
+			try:
+				size, address = self.sock.recvfrom_into(self.buffer)
+			except socket.error:
+				break
+			batch += 1
+			self.handle_message((self.view[:size], address))
+		if not batch:
+			return
+		self.batches += 1
+		self.datagrams += batch
+		self.maxBatch = max(self.maxBatch, batch)
+
+	def get_kernel_drops(self):
+		"""
+		Reads how many datagrams the kernel dropped on the socket because its buffer was full
+		@return drops (None if /proc/net/udp is not there)
+		"""
+		inode = str(os.fstat(self.sock.fileno()).st_ino)
+		try:
+			with open('/proc/net/udp', 'r') as rfile:
+				for line in rfile:
+					fields = line.split()
+					if len(fields) > 12 and fields[9] == inode:
+						return int(fields[12])
+		except IOError:
+			return None
+		return None
+
+	def get_stats(self):
+		"""
+		Returns the receive batches, the datagrams in them, the largest batch and the kernel drops
+		@return dict
+		"""
+		return {
+			'batches': self.batches,
+			'datagrams': self.datagrams,
+			'maxBatch': self.maxBatch,
+			'kernelDrops': self.get_kernel_drops(),
+			'lostHeartbeats': self.lostHeartbeats
+			}
+
+	def report_stats(self, interval):
+		"""
+		Prints the stats every interval seconds
+		@input interval
+		"""
+		stats = self.get_stats()
+		print 'RECEIVER: %d datagrams in %d batches, largest %d, %s kernel drops, %d lost heartbeats' % (
+			stats['datagrams'], stats['batches'], stats['maxBatch'], stats['kernelDrops'], stats['lostHeartbeats'])
+		self.loop.call_later(interval, self.report_stats, interval)
+
+	def determine_cost(self, order, peer):
+		"""
+		Determines the cost of an order based on the state of an elevator,
+		as the predicted arrival time in seconds plus penalties for the work already queued
+		@input order, peer (PeerState)
 		@return cost
 		"""
-		direction = int(message['direction'])
-		currentFloor = int(message['currentFloor'])
-		orderQueue = OrderQueue.deserialize(message['orderQueue'])
+		currentFloor = peer.currentFloor
+		if peer.position is not None:
+			# Between sensors the estimated position is more accurate than the last floor
+			currentFloor = peer.get_position(monotonic())
+		orderQueue = peer.orderQueue
+		travelModel = peer.travelModel
 		orderweight = config.ORDER_WEIGHT
-		floorweight = config.FLOOR_WEIGHT
 		directionweight = config.DIRECTION_WEIGHT
 		cost = 0
 		if orderQueue.has_order_in_floor_and_direction(order.direction, order.floor):
 			return -1
-		floors = (currentFloor, order.floor)
-		for _order in orderQueue.yield_orders(exclude=(None,)):
+		if currentFloor < 0:
+			# Position unknown until the first sensor edge
+			currentFloor = 0
+		stops = []
+		for _order in peer.orders:
+			if min(currentFloor, order.floor) <= _order.floor <= max(currentFloor, order.floor) and _order.floor != order.floor:
+				# The elevator stops here on its way to the order
+				stops.append(_order.floor)
 			if min(currentFloor, _order.floor) <= order.floor <= max(currentFloor, _order.floor):
 				if order.direction != _order.direction:
 					cost += directionweight
 			cost += orderweight
-		return cost+abs(floors[0]-floors[1])*floorweight
+		if order.destination is not None:
+			# Grouping trips: a destination the elevator stops in anyway costs no extra stop
+			if not orderQueue.has_order_in_floor_and_direction(ORDERDIR.IN, order.destination) and order.destination not in peer.destinationFloors:
+				cost += travelModel.dwellSeconds[order.destination]
+		# An elevator already late for one of its orders should not take on more
+		cost += max(0.0, peer.oldestWait - config.MAX_WAIT_SECONDS)
+		return cost+travelModel.predict_arrival(currentFloor, order.floor, stops)
 
 	def handle_new_elevator(self, ip):
 		"""
@@ -110,23 +218,70 @@ class NetworkReceiver():
 		@input ip
 		"""
 		if ip not in self.elevators and ip != self.ip:
-			self.startedOrders[ip] = []
+			self.startedOrders[ip] = set()
 			print 'NEW ELEVATOR WITH IP %s DISCOVERED' % ip
 		
+	def track_deadline(self, ip, peer):
+		"""
+		Starts watching an elevator for a timeout, waking the loop up earlier if its deadline is the nearest one
+		@input ip, peer (PeerState)
+		"""
+		if ip in self.deadlines:
+			return
+		deadline = peer.lastSeen + config.TIMEOUT_LIMIT
+		self.deadlines[ip] = deadline
+		heapq.heappush(self.deadlineHeap, (deadline, ip))
+		self.schedule_timeouts()
+
+	def schedule_timeouts(self):
+		"""
+		Sets the timer to the nearest deadline, so select blocks until then
+		"""
+		if not self.deadlineHeap:
+			return
+		deadline = self.deadlineHeap[0][0]
+		if self.timeoutTimer is not None:
+			if self.timeoutTimer.deadline <= deadline:
+				return
+			self.timeoutTimer.cancel()
+		self.timeoutTimer = self.loop.call_later(max(0, deadline - monotonic()), self.handle_timeouts)
+
 	def handle_timeouts(self):
 		"""
-		Handles when a elevator has timed out, disconnecting it and removing it from its list of elevators
+		Handles when a elevator has timed out, disconnecting it and removing it from its list of elevators.
+		Only looks at the elevators whose deadline has passed
+		"""
+		self.timeoutTimer = None
+		now = monotonic()
+		while self.deadlineHeap and self.deadlineHeap[0][0] <= now:
+			deadline, ip = heapq.heappop(self.deadlineHeap)
+			if self.deadlines.get(ip) != deadline:
+				# Left over from an elevator already removed
+				continue
+			deadline = self.elevators[ip].lastSeen + config.TIMEOUT_LIMIT
+			if deadline > now:
+				self.deadlines[ip] = deadline
+				heapq.heappush(self.deadlineHeap, (deadline, ip))
+			else:
+				self.remove_elevator(ip)
+		self.schedule_timeouts()
+
+	def remove_elevator(self, ip):
+		"""
+		Disconnects an elevator, giving its orders to the others
+		@input ip
 		"""
-		for ip, message in self.elevators.items():
-			if 'timestamp' not in message:
-				message['timestamp'] = time.time()
-			timestamp = message['timestamp']
-			if time.time() - timestamp > config.TIMEOUT_LIMIT:
-				self.distribute_dead_orders(ip)
-				del self.elevators[ip] # BROADCAST ORDERS
-				if ip != self.ip:
-					del self.startedOrders[ip]
-				print 'DELETED ELEVATOR WITH IP %s' % ip
+		self.distribute_dead_orders(ip)
+		del self.elevators[ip] # BROADCAST ORDERS
+		self.deadlines.pop(ip, None)
+		self.handle_global_orders(ip, None)
+		self.sequences.pop(ip, None)
+		self.travelModels.pop(ip, None)
+		self.seenNewOrders.pop(ip, None)
+		self.resyncRequested.pop(ip, None)
+		if ip != self.ip:
+			del self.startedOrders[ip]
+		print 'DELETED ELEVATOR WITH IP %s' % ip
 
 
 	def distribute_dead_orders(self, dead_ip):
@@ -134,7 +289,9 @@ class NetworkReceiver():
 		Distributes the external orders of the dead elevator
 		@input dead_ip
 		"""
-		for order in OrderQueue.deserialize(self.elevators[dead_ip]['orderQueue']).yield_orders():
+		orders = list(self.elevators[dead_ip].orderQueue.yield_orders())
+		orders += [Order.from_destination(origin, destination) for origin, destination in self.elevators[dead_ip].destinations]
+		for order in orders:
 			ip, value = self.get_best_elevator_for_order(order, exclude=dead_ip)
 			if value >= 0:
 				self.distribute_order(ip, order)
@@ -149,22 +306,38 @@ class NetworkReceiver():
 		@return (ip, cost) [(-1, -1) if no elevator fits (none is alive)]
 		"""
 		scores = {}
-		for ip, message in self.elevators.items():
+		for ip, peer in self.elevators.items():
 			if ip != exclude:
-				scores[ip] = self.determine_cost(order, message)
+				scores[ip] = self.determine_cost(order, peer)
+		if scores:
+			# Full elevators take no hall calls, unless one already has it or all are full
+			roomScores = dict((ip, cost) for ip, cost in scores.items() if cost < 0 or self.elevators[ip].load < config.LOAD_FULL_THRESHOLD)
+			scores = roomScores or scores
+		if scores and self.dispatchMode.is_zoned():
+			# Only elevators serving the zone of the order, unless one already has it or none is alive there
+			zones = get_zones(scores.keys())
+			zoneScores = dict((ip, cost) for ip, cost in scores.items() if cost < 0 or in_zone(zones[ip], order.floor))
+			scores = zoneScores or scores
 		if scores:
 			best = min(scores, key=scores.get)
 			return best, scores[best]
 		print "NO ELEVATORS CAN TAKE THIS ORDER"
 		return -1, -1
 
+	def has_room_elsewhere(self):
+		"""
+		Returns if another elevator can take hall calls, so a full car handing one back does not get it again
+		@return true, false
+		"""
+		return any(ip != self.ip and peer.load < config.LOAD_FULL_THRESHOLD for ip, peer in self.elevators.items())
+
 	def check_if_order_started(self, ip, order):
 		"""
-		A separate threads runs this to check whether the order is started. If not, it finds a new elevator to handle it.
+		A timer runs this to check whether the order is started. If not, it finds a new elevator to handle it.
 		@input ip, order
 		"""
 		if ip in self.startedOrders:
-			if order.serialize() in self.startedOrders[ip]:
+			if order.id in self.startedOrders[ip]:
 				self.distribute_order(ip, order)
 
 	def distribute_order(self, ip, order):
@@ -173,54 +346,187 @@ class NetworkReceiver():
 		@input ip, order
 		"""
 		if self.ip == ip:
-			self.callbackQueue.put(partial(self.addOrderCallback, order))
+			self.loop.call_soon(self.addOrderCallback, order)
 		else:
-			self.startedOrders[ip].append(order.serialize())
-			Timer(1/config.HEARTBEAT_FREQUENCY*config.BROADCAST_HEARTBEATS, self.check_if_order_started, (ip, order)).start()
+			self.startedOrders[ip].add(order.id)
+			self.loop.call_later(1/config.HEARTBEAT_FREQUENCY*config.BROADCAST_HEARTBEATS, self.check_if_order_started, ip, order)
 
 
 
-	def handle_new_orders(self, ip):
+	def handle_new_orders(self, ip, exclude=None):
 		"""
 		Handles new orders broadcasted from a certain ip
-		@input ip
-		"""
-		newOrders = self.elevators[ip]['newOrders']
+		@input ip, exclude (ip not to give the orders to, default None)
+		"""
+		newOrders = self.elevators[ip].newOrders
+		# The orders of a heartbeat can be split over several datagrams, so remember them for a while
+		seen = self.seenNewOrders.setdefault(ip, {})
+		now = monotonic()
+		for order, seenAt in seen.items():
+			if now - seenAt > 2 * config.BROADCAST_HEARTBEATS / config.HEARTBEAT_FREQUENCY:
+				del seen[order]
 		for order in newOrders:
+			firstSeen = order not in seen
+			seen[order] = now
 			order = Order.deserialize(order)
-			best_ip, value = self.get_best_elevator_for_order(order)
-			if value >= 0:
+			if firstSeen:
+				# Orders are broadcasted for several heartbeats, only count the first one
+				self.demandModel.record_call(order.floor)
+			best_ip, value = self.get_best_elevator_for_order(order, exclude)
+			if value >= 0 or (best_ip != -1 and order.destination is not None):
+				# A car already having the hall call takes the trip at no cost, but still has to learn the destination
 				self.distribute_order(best_ip, order)
+				if firstSeen and ip == self.ip and order.destination is not None:
+					# The passenger entered the destination on this elevator's panel
+					print 'PASSENGER FROM FLOOR %d TO FLOOR %d: TAKE ELEVATOR %s' % (order.floor, order.destination, best_ip)
+
+	def is_idle(self, peer):
+		"""
+		Returns if an elevator has nothing to do
+		@input peer (PeerState)
+		@return true, false
+		"""
+		return peer.idle
+
+	def get_parking_floor(self):
+		"""
+		Decides where this elevator should park: the nearest of the floors the demand model picks for the idle
+		elevators that no other elevator is parked in or heading for. The demand models of the elevators are built
+		from the calls each one saw and can differ, so the floor is only claimed in the heartbeat at first, and
+		parking_conflict settles two elevators claiming it at once before either moves
+		@return floor (None if this elevator is not known to be idle)
+		"""
+		me = self.elevators.get(self.ip)
+		if me is None or not self.is_idle(me):
+			return None
+		floors = self.demandModel.get_parking_floors(len([peer for peer in self.elevators.values() if self.is_idle(peer)]))
+		claimed = set()
+		for ip, peer in self.elevators.items():
+			if ip == self.ip:
+				continue
+			if peer.parking >= 0:
+				claimed.add(peer.parking)
+			elif self.is_idle(peer) and (peer.currentFloor != me.currentFloor or ip < self.ip):
+				# Parked there already, of two idle elevators in the same floor the lower IP stays
+				claimed.add(peer.currentFloor)
+		# Never park together with another elevator
+		free = [f for f in floors if f not in claimed] or [f for f in xrange(config.NUM_FLOORS) if f not in claimed]
+		if not free:
+			return None
+		return min(free, key=lambda f: (abs(f - me.currentFloor), f))
+
+	def parking_conflict(self, floor):
+		"""
+		Returns if an elevator with a lower IP claims the same parking floor, which it keeps
+		@input floor
+		@return true, false
+		"""
+		return any(ip < self.ip and peer.parking == floor for ip, peer in self.elevators.items())
+
+	def handle_global_orders(self, ip, hallFloors):
+		"""
+		Updates the count of elevators having each hall order with the change in the hall orders of one elevator,
+		setting a light only when the first elevator takes the order or the last one drops it
+		@input ip, hallFloors (dict of direction to floors, None when the elevator is removed)
+		"""
+		oldFloors = self.hallFloors.pop(ip, None)
+		if hallFloors is not None:
+			self.hallFloors[ip] = hallFloors
+		for direction, counts in self.globalOrders.items():
+			old = oldFloors[direction] if oldFloors else frozenset()
+			new = hallFloors[direction] if hallFloors else frozenset()
+			if old is new:
+				continue
+			for floor in new - old:
+				counts[floor] = counts.get(floor, 0) + 1
+				if counts[floor] == 1:
+					self.loop.call_soon(self.setLightCallback, direction, floor, True)
+			for floor in old - new:
+				counts[floor] -= 1
+				if not counts[floor]:
+					del counts[floor]
+					self.loop.call_soon(self.setLightCallback, direction, floor, False)
+
+	def handle_started_orders(self, ip, peer):
+		"""
+		Removes the started order if the assigned elevator started the job.
+		@input ip, peer
+		"""
+		if ip == self.ip:
+			return
+		startedOrders = peer.startedOrders
+		for order in startedOrders:
+			self.startedOrders[ip].discard(order)
 
-	def handle_global_orders(self):
+	def check_sequence(self, ip, message):
 		"""
-		Updates self.globalOrders to keep track of all the elevators in the whole system and settings lights accordingly.
+		Counts the heartbeats lost since the last one from the ip
+		@input ip, message
 		"""
-		newGlobalOrders = {ORDERDIR.UP: [False]*config.NUM_FLOORS, ORDERDIR.DOWN: [False]*config.NUM_FLOORS}
-		for ip, message in self.elevators.items():
-			orderQueue = OrderQueue.deserialize(message['orderQueue'])
-			for direction, floors in orderQueue.orders.items():
-				if direction == ORDERDIR.IN:
-					continue
-				for floor in range(len(floors)):
-					newGlobalOrders[direction][floor] |= floors[floor]
-		for direction, floors in newGlobalOrders.items():
-			for floor in range(len(floors)):
-				if newGlobalOrders[direction][floor] != self.globalOrders[direction][floor]:
-					self.callbackQueue.put(partial(self.setLightCallback, direction, floor, floors[floor]))
-		self.globalOrders = newGlobalOrders
+		sequence = message.get('seq')
+		last = self.sequences.get(ip)
+		if last is not None and sequence is not None:
+			missing = (sequence - last - 1) & 0xffffffff
+			if missing < 0x80000000:
+				self.lostHeartbeats += missing
+		self.sequences[ip] = sequence
 
-	def handle_started_orders(self, ip, message):
+	def request_resync(self, ip, nodeId):
 		"""
-		Removes the started order if the assigned elevator started the job.
+		Asks an elevator for its full state, at most every RESYNC_HOLDOFF_SECONDS
+		@input ip, nodeId
+		"""
+		now = monotonic()
+		if now - self.resyncRequested.get(ip, -config.RESYNC_HOLDOFF_SECONDS) < config.RESYNC_HOLDOFF_SECONDS:
+			return
+		self.resyncRequested[ip] = now
+		try:
+			self.sock.sendto(wire.encode_resync(self.nodeId, 0, nodeId, config.WIRE_DEBUG_JSON), (config.MCAST_GROUP, config.MCAST_PORT))
+		except socket.error:
+			pass
+
+	def handle_keepalive(self, ip, message):
+		"""
+		Updates the last full state of the elevator with a keepalive, asking for the full state
+		if the keepalive shows it was lost
 		@input ip, message
+		@return PeerState (None if the elevator is not known yet)
 		"""
-		if ip == self.ip:
+		peer = self.elevators.get(ip)
+		if peer is None or peer.stateVersion != message.get('stateVersion'):
+			self.request_resync(ip, message['node'])
+		if peer is None:
+			return None
+		peer.update(message)
+		return peer
+
+	def handle_state(self, ip, message):
+		"""
+		Decodes the state of a full heartbeat, unless it is a refresh of the state version already decoded
+		@input ip, message
+		@return PeerState
+		"""
+		peer = self.elevators.get(ip)
+		if peer is not None and peer.stateVersion is not None and peer.stateVersion == message.get('stateVersion'):
+			peer.update(message)
+			return peer
+		if 'mode' in message and self.dispatchMode.merge(message['mode']):
+			print 'DISPATCH MODE CHANGED TO %s' % DISPATCHMODE.NAMES[self.dispatchMode.mode]
+		return PeerState(message, self.travelModels.get(ip))
+
+	def handle_travel_model(self, ip, message):
+		"""
+		Keeps the travel model an elevator sends apart from its state, for the states decoded after it
+		@input ip, message
+		"""
+		try:
+			travelModel = TravelModel.deserialize(message['travelModel'])
+		except ValueError:
+			print 'MALFORMED TRAVEL MODEL FROM %s' % ip
 			return
-		startedOrders = message['startedOrders']
-		for order in startedOrders:
-			if order in self.startedOrders[ip]:
-				self.startedOrders[ip].remove(order)
+		self.travelModels[ip] = travelModel
+		if ip in self.elevators:
+			self.elevators[ip].travelModel = travelModel
 
 	def handle_message(self, message):
 		"""
@@ -228,56 +534,228 @@ class NetworkReceiver():
 		@input message
 		"""
 		message, (ip, port) = message
-		message = json.loads(message)
+		try:
+			message = wire.decode(message)
+		except ValueError:
+			print 'MALFORMED MESSAGE FROM %s' % ip
+			return
+		if 'resync' in message:
+			if message['resync'] == self.nodeId and self.resyncCallback:
+				self.resyncCallback()
+			return
+		self.check_sequence(ip, message)
+		if message.get('travel'):
+			self.handle_travel_model(ip, message)
+			return
+		if message.get('keepalive'):
+			peer = self.handle_keepalive(ip, message)
+			if peer is None:
+				return
+		else:
+			peer = self.handle_state(ip, message)
+		if message.get('leaving'):
+			# The elevator is shutting down, reassign its orders now instead of waiting for the timeout
+			if ip in self.elevators:
+				self.elevators[ip] = peer
+				# Hall calls pressed on it in its last heartbeats go to the others
+				self.handle_new_orders(ip, exclude=ip)
+				self.remove_elevator(ip)
+			return
 		self.handle_new_elevator(ip)
-		self.elevators[ip] = message
-		self.elevators[ip]['timestamp'] = time.time()
-		self.handle_started_orders(ip, message)
+		self.elevators[ip] = peer
+		self.track_deadline(ip, peer)
+		self.handle_started_orders(ip, peer)
 		self.handle_new_orders(ip)
-		self.handle_global_orders()
+		self.handle_global_orders(ip, peer.hallFloors)
 
 
 
-class NetworkSender(Thread):
+class NetworkSender:
 
-	def __init__(self, elevatorInfo, newOrderQueue, callbackQueue, startedOrderQueue, lostConnectionCallback):
+	def __init__(self, elevatorInfo, newOrderQueue, loop, startedOrderQueue, lostConnectionCallback, dispatchMode, nodeId=0):
 		"""
 		Initializing the networkSender
-		"""
-		super(NetworkSender, self).__init__()
+		@input nodeId (put in the header of every heartbeat)
+		"""
+		self.nodeId = nodeId
+		self.sequence = 0
+		self.state = None
+		self.stateVersion = 0
+		self.lastFullState = 0.0
+		self.fullStateRequested = False
+		self.stateInfo = None
+		self.stateLive = None
+		self.payloadKey = None
+		self.payloads = None
+		self.travelModel = None
+		self.travelModelPending = False
+		self.orderCount = 0
+		self.totalOrderLatency = 0.0
+		self.maxOrderLatency = 0.0
+		self.extraDatagrams = 0
 		self.elevatorInfo = elevatorInfo
 		self.newOrderQueue = newOrderQueue
-		self.callbackQueue = callbackQueue
+		self.loop = loop
+		self.dispatchMode = dispatchMode
 		self.startedOrderQueue = startedOrderQueue
 		self.lostConnectionCallback = lostConnectionCallback
 		self.message = {'newOrders': [], 'startedOrders': []}
 		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
 		self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-		self.interrupt = False
-		self.daemon = True
+		self.sock.setblocking(0)
 
 	def build_message(self):
 		"""
-		Builds a JSONmessage based on the info about its elevator,
-		starting a thread that removes the order in x seconds
-		@return JSONmessage
-		"""
+		Builds a heartbeat based on the info about its elevator,
+		scheduling a timer that removes the order in x seconds.
+		The full state is only sent when it changed, was asked for or every FULL_STATE_SECONDS, otherwise a keepalive.
+		The payloads after the headers are cached, and only encoded again when the state or the orders in them change.
+		Orders that do not fit in MAX_DATAGRAM_BYTES spill into extra keepalives sent right after the heartbeat
+		@return list of datagrams (binary, or JSON with WIRE_DEBUG_JSON)
+		"""
+		changed = self.update_state()
+		now = monotonic()
+		self.drain_orders(now)
+		refresh = self.fullStateRequested or now - self.lastFullState >= config.FULL_STATE_SECONDS
+		full = changed or refresh or self.message.get('leaving')
+		if full:
+			self.fullStateRequested = False
+			self.lastFullState = now
+		if config.WIRE_DEBUG_JSON:
+			datagrams = []
+			for chunk, state in self.split_orders(full):
+				self.sequence += 1
+				datagrams.append(wire.encode(chunk, self.nodeId, self.sequence, self.stateVersion, state, True))
+			self.extraDatagrams += len(datagrams) - 1
+			return datagrams
+		payloadKey = (self.stateVersion, full, tuple(self.message['newOrders']), tuple(self.message['startedOrders']), bool(self.message.get('leaving')))
+		if payloadKey != self.payloadKey:
+			self.payloadKey = payloadKey
+			self.payloads = [wire.encode_payload(chunk, state) for chunk, state in self.split_orders(full)]
+		datagrams = []
+		for flags, payload in self.payloads:
+			self.sequence += 1
+			datagrams.append(wire.encode_header(flags, self.nodeId, self.sequence, self.stateVersion) + payload)
+		self.extraDatagrams += len(datagrams) - 1
+		if self.travelModelPending or refresh:
+			# The travel model is only sent when it changed, with the periodic full state and on a resync
+			self.travelModelPending = False
+			self.sequence += 1
+			datagrams.append(wire.encode_header(wire.FLAG.TRAVELMODEL, self.nodeId, self.sequence, self.stateVersion) + self.travelModel)
+		return datagrams
+
+	def drain_orders(self, now):
+		"""
+		Moves every pending new and started order into the message, to be broadcasted for BROADCAST_HEARTBEATS,
+		and measures how long the new orders waited to be broadcasted
+		@input now
+		"""
+		for queue, key, remove in ((self.newOrderQueue, 'newOrders', self.remove_order), (self.startedOrderQueue, 'startedOrders', self.remove_started_order)):
+			while True:
+				try:
+					order, queued = queue.get_nowait()
+				except Empty:
+					break
+				order = order.serialize()
+				self.message[key].append(order)
+				self.loop.call_later(1/config.HEARTBEAT_FREQUENCY*config.BROADCAST_HEARTBEATS, remove, order)
+				if key == 'newOrders':
+					self.orderCount += 1
+					self.totalOrderLatency += now - queued
+					self.maxOrderLatency = max(self.maxOrderLatency, now - queued)
+
+	def split_orders(self, full):
+		"""
+		Splits the orders of the message over as many datagrams as needed to stay below MAX_DATAGRAM_BYTES,
+		the first carrying the state if it is sent in full
+		@input full
+		@return list of (message, state) with state None for a keepalive
+		"""
+		state = self.state if full else None
+		newOrders = self.message['newOrders']
+		startedOrders = self.message['startedOrders']
+		chunks = []
+		while True:
+			room = (config.MAX_DATAGRAM_BYTES - wire.HEADER.size - len(state or '') - 2 * wire.COUNT.size) // wire.ORDER_ID.size
+			newCount = min(room, 0xff, len(newOrders))
+			startedCount = min(room - newCount, 0xff, len(startedOrders))
+			chunks.append((dict(self.message, newOrders=newOrders[:newCount], startedOrders=startedOrders[:startedCount]), state))
+			newOrders = newOrders[newCount:]
+			startedOrders = startedOrders[startedCount:]
+			if not newOrders and not startedOrders:
+				break
+			state = None
+		return chunks
+
+	def get_stats(self):
+		"""
+		Returns how long new orders waited to be broadcasted, and how many extra datagrams the orders needed
+		@return dict
+		"""
+		return {
+			'orders': self.orderCount,
+			'meanOrderLatency': self.totalOrderLatency / self.orderCount if self.orderCount else 0.0,
+			'maxOrderLatency': self.maxOrderLatency,
+			'extraDatagrams': self.extraDatagrams
+			}
+
+	def report_stats(self, interval):
+		"""
+		Prints the stats every interval seconds
+		@input interval
+		"""
+		stats = self.get_stats()
+		print 'SENDER: %d new orders, press to broadcast mean %.2f ms max %.2f ms, %d extra datagrams' % (
+			stats['orders'], stats['meanOrderLatency']*1000, stats['maxOrderLatency']*1000, stats['extraDatagrams'])
+		self.loop.call_later(interval, self.report_stats, interval)
+
+	def update_state(self):
+		"""
+		Updates the state in the message from elevatorInfo and the live position, encoding it and bumping the
+		state version if it changed. Nothing is done while elevatorInfo is the same and the live values did not change.
+		The position only counts as changed when it crosses a POSITION_STEP_FLOORS step, and is then sent as it is
+		at that moment, for the receivers to extrapolate from with the velocity
+		@return true if the state version was bumped
+		"""
+		positionEstimator = self.elevatorInfo['positionEstimator']
+		position = positionEstimator.get_position()
+		live = (
+			int(position // config.POSITION_STEP_FLOORS) if position is not None else None,
+			round(positionEstimator.get_velocity(), 3),
+			int(self.elevatorInfo['orderQueue'].get_oldest_wait()),
+			tuple(self.dispatchMode.serialize())
+			)
+		if self.elevatorInfo is self.stateInfo and live == self.stateLive:
+			return False
+		self.stateInfo = self.elevatorInfo
+		self.stateLive = live
 		self.message['direction'] = self.elevatorInfo['direction']
 		self.message['currentFloor'] = self.elevatorInfo['currentFloor']
 		self.message['orderQueue'] = self.elevatorInfo['orderQueue'].serialize()
-		try:
-			order = self.newOrderQueue.get_nowait().serialize()
-			self.message['newOrders'].append(order)
-			Timer(1/config.HEARTBEAT_FREQUENCY*config.BROADCAST_HEARTBEATS, self.remove_order, (order, )).start()
-		except:
-			pass
-		try:
-			startedorder = self.startedOrderQueue.get_nowait().serialize()
-			self.message['startedOrders'].append(startedorder)
-			Timer(1/config.HEARTBEAT_FREQUENCY*config.BROADCAST_HEARTBEATS, self.remove_started_order, (startedorder, )).start()
-		except:
-			pass
-		return json.dumps(self.message)
+		_, self.message['velocity'], self.message['oldestWait'], mode = live
+		self.message['position'] = round(position, 2) if position is not None else None
+		self.message['travelModel'] = self.elevatorInfo['travelModel'].serialize()
+		parkingFloor = self.elevatorInfo['parkingFloor']
+		self.message['parking'] = parkingFloor if parkingFloor is not None else -1
+		self.message['mode'] = list(mode)
+		self.message['destinations'] = self.elevatorInfo['destinations']
+		self.message['load'] = round(self.elevatorInfo['load'], 2)
+		travelModel = wire.encode_travel_model(self.message['travelModel'])
+		if travelModel != self.travelModel:
+			self.travelModel = travelModel
+			self.travelModelPending = True
+		state = wire.encode_state(self.message)
+		if state == self.state:
+			return False
+		self.state = state
+		self.stateVersion += 1
+		return True
+
+	def request_full_state(self):
+		"""
+		Sends the full state with the next heartbeat, for an elevator that missed it
+		"""
+		self.fullStateRequested = True
 
 	def remove_started_order(self, order):
 		"""
@@ -299,26 +777,57 @@ class NetworkSender(Thread):
 		except Exception, e:
 			print e
 
-	def run(self):
+	def start(self):
+		""" Starts broadcasting on the event loop """
+		self.loop.call_soon(self.send_heartbeat)
+
+	def send_leaving(self):
+		"""
+		Broadcasts a last heartbeat telling the other elevators to take over the orders at once.
+		Sent a few times, since a lost datagram would leave them waiting for TIMEOUT_LIMIT.
+		"""
+		self.message['leaving'] = True
+		datagrams = self.build_message()
+		for _ in xrange(config.LEAVING_HEARTBEATS):
+			try:
+				for datagram in datagrams:
+					self.sock.sendto(datagram, (config.MCAST_GROUP, config.MCAST_PORT))
+			except socket.error:
+				return
+
+	def send_heartbeat(self):
 		""" 
-		Constantly broadcasting information over the network
-		if the connection breaks, it sends a message to the elevator and deleting orders. 
+		Broadcasting information over the network every heartbeat
+		if the connection breaks, it sends a message to the elevator and deleting orders.
+		A full send buffer only skips the rest of this heartbeat, the state is sent in full with the next one
+		"""
+		try:
+			for datagram in self.build_message():
+				self.sock.sendto(datagram, (config.MCAST_GROUP, config.MCAST_PORT))
+		except socket.error, e:
+			if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+				self.lose_connection()
+				return
+			self.request_full_state()
+		except:
+			self.lose_connection()
+			return
+		self.loop.call_later(1/config.HEARTBEAT_FREQUENCY, self.send_heartbeat)
+
+	def lose_connection(self):
 		"""
+		Tells the elevator the network is gone, deleting new orders, and tries again after RECONNECT_SECONDS
+		"""
+		print 'NO NETWORK, deleting orders and sleeping for %d seconds' % config.RECONNECT_SECONDS
+		self.loop.call_soon(self.lostConnectionCallback)
 		while True:
+			# EMPTYING newOrderQueue to discard all new orders
 			try:
-				self.sock.sendto(self.build_message(), (config.MCAST_GROUP, config.MCAST_PORT))
+				self.newOrderQueue.get_nowait()
 			except:
-				print 'NO NETWORK, deleting orders and sleeping for %d seconds' % config.RECONNECT_SECONDS
-				self.callbackQueue.put(self.lostConnectionCallback)
-				while True:
-					# EMPTYING newOrderQueue to discard all new orders
-					try:
-						self.newOrderQueue.get_nowait()
-					except:
-						break
-
-				sleep(config.RECONNECT_SECONDS)
-			sleep(1/config.HEARTBEAT_FREQUENCY)
+				break
+
+		self.loop.call_later(config.RECONNECT_SECONDS, self.send_heartbeat)
 
 if __name__ == '__main__':
 	a = NetworkHandler()
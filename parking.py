@@ -0,0 +1,77 @@
+import time
+import config
+
+# Floors without any recorded calls still get a little weight, so idle cars spread out evenly
+PRIOR_WEIGHT = 0.1
+
+
+class DemandModel:
+	"""
+	Keeps decaying counts of hall calls per floor for every hour of the day
+	"""
+	def __init__(self, halfLife=config.DEMAND_HALF_LIFE_SECONDS):
+		"""
+		Initializing with no recorded calls
+		@input halfLife (seconds until a recorded call counts half)
+		"""
+		self.halfLife = halfLife
+		self.counts = [[0.0] * config.NUM_FLOORS for _ in xrange(24)]
+		self.updated = [0.0] * 24
+
+	def decay(self, hour, now):
+		"""
+		Decays the counts of an hour up to now
+		@input hour, now
+		"""
+		factor = 0.5 ** ((now - self.updated[hour]) / self.halfLife)
+		self.counts[hour] = [count * factor for count in self.counts[hour]]
+		self.updated[hour] = now
+
+	def record_call(self, floor, now=None):
+		"""
+		Records a hall call in the current hour
+		@input floor, now (default time.time())
+		"""
+		if now is None:
+			now = time.time()
+		hour = time.localtime(now).tm_hour
+		self.decay(hour, now)
+		self.counts[hour][floor] += 1
+
+	def get_weights(self, now=None):
+		"""
+		Returns the expected share of hall calls per floor in the current hour
+		@input now (default time.time())
+		@return list of weights
+		"""
+		if now is None:
+			now = time.time()
+		hour = time.localtime(now).tm_hour
+		self.decay(hour, now)
+		return [count + PRIOR_WEIGHT for count in self.counts[hour]]
+
+	def get_parking_floors(self, count, now=None):
+		"""
+		Greedily picks distinct floors that minimize the expected distance from a hall call
+		to the nearest of them
+		@input count, now (default time.time())
+		@return sorted list of floors
+		"""
+		weights = self.get_weights(now)
+		chosen = []
+		for _ in xrange(min(count, config.NUM_FLOORS)):
+			best = min(
+				(floor for floor in xrange(config.NUM_FLOORS) if floor not in chosen),
+				key=lambda candidate: expected_distance(weights, chosen + [candidate])
+				)
+			chosen.append(best)
+		return sorted(chosen)
+
+
+def expected_distance(weights, floors):
+	"""
+	Weighted distance from every floor to the nearest of the given floors
+	@input weights, floors
+	@return distance
+	"""
+	return sum(weight * min(abs(floor - parked) for parked in floors) for floor, weight in enumerate(weights))
@@ -0,0 +1,66 @@
+from models import OrderQueue, ORDERDIR
+from travelmodel import TravelModel
+from clock import monotonic
+import config
+
+
+class PeerState:
+	"""
+	The state of an elevator as decoded from its heartbeats. It is built once per state version,
+	so the cost function and the lamps read the decoded orders instead of decoding them for every use
+	"""
+	def __init__(self, message, travelModel=None):
+		"""
+		Decoding the state of a full heartbeat
+		@input message (decoded full heartbeat), travelModel (the last one the elevator sent, for binary heartbeats
+		which carry it in datagrams of their own)
+		"""
+		self.stateVersion = message.get('stateVersion')
+		self.direction = int(message['direction'])
+		self.currentFloor = int(message['currentFloor'])
+		self.position = float(message['position']) if message.get('position') is not None else None
+		self.velocity = float(message.get('velocity', 0))
+		self.orderQueue = OrderQueue.deserialize(message['orderQueue'])
+		try:
+			self.travelModel = TravelModel.deserialize(message['travelModel'])
+		except (KeyError, ValueError):
+			self.travelModel = travelModel or TravelModel()
+		self.parking = int(message.get('parking', -1))
+		self.load = float(message.get('load', 0))
+		self.oldestWait = float(message.get('oldestWait', 0))
+		self.mode = message.get('mode')
+		self.destinations = [(int(floor), int(destination)) for floor, destination in message.get('destinations', [])]
+		self.destinationFloors = set(destination for _, destination in self.destinations)
+		self.orders = list(self.orderQueue.yield_orders(exclude=()))
+		self.hallFloors = {
+			ORDERDIR.UP: frozenset(self.orderQueue.get_floors(ORDERDIR.UP)),
+			ORDERDIR.DOWN: frozenset(self.orderQueue.get_floors(ORDERDIR.DOWN))
+			}
+		self.idle = not self.orders and not self.velocity
+		# The position is only sent again when the car crosses a step, so it is extrapolated from here
+		self.decodedAt = monotonic()
+		self.update(message)
+
+	def get_position(self, now):
+		"""
+		Extrapolates the position of the car from the one in the state, moving at its velocity,
+		within one floor of its last floor like the estimate of the car itself
+		@input now (monotonic time)
+		@return position (None if unknown)
+		"""
+		if self.position is None:
+			return None
+		position = self.position + self.velocity * (now - self.decodedAt)
+		low = max(0, self.currentFloor - 1)
+		high = min(config.NUM_FLOORS - 1, self.currentFloor + 1)
+		return min(max(position, low), high)
+
+	def update(self, message):
+		"""
+		Takes the parts sent with every heartbeat, full or keepalive
+		@input message
+		"""
+		self.newOrders = message.get('newOrders', [])
+		self.startedOrders = message.get('startedOrders', [])
+		self.seq = message.get('seq')
+		self.lastSeen = monotonic()
@@ -0,0 +1,89 @@
+from channels import OUTPUT
+from clock import monotonic
+import config
+
+
+class PositionEstimator:
+	"""
+	Estimates the fractional position of the car between the floor sensors by integrating
+	the commanded speed and direction of the motor. Every sensor edge snaps the estimate
+	back to the floor it belongs to.
+	"""
+	def __init__(self, floorSeconds=config.FLOOR_TRAVEL_SECONDS):
+		"""
+		Initializing with an unknown position
+		@input floorSeconds (seconds to travel one floor at config.SPEED)
+		"""
+		self.floorSeconds = floorSeconds
+		self.lastFloor = -1
+		self.anchorPosition = None
+		self.anchorTime = monotonic()
+		self.velocity = 0.0
+
+	def set_anchor(self, now):
+		"""
+		Folds the movement since the last anchor into the anchor position
+		@input now
+		"""
+		self.anchorPosition = self.get_position(now)
+		self.anchorTime = now
+
+	def motor_started(self, direction, speed=config.SPEED):
+		"""
+		Called when the motor is commanded to run
+		@input direction (OUTPUT.MOTOR_UP or OUTPUT.MOTOR_DOWN), speed
+		"""
+		self.set_anchor(monotonic())
+		sign = 1 if direction == OUTPUT.MOTOR_UP else -1
+		self.velocity = sign * float(speed) / config.SPEED / self.floorSeconds
+
+	def motor_stopped(self):
+		"""
+		Called when the motor is commanded to stop
+		"""
+		self.set_anchor(monotonic())
+		self.velocity = 0.0
+
+	def sensor_edge(self, floor, now=None):
+		"""
+		Corrects the estimate when the sensor of a floor goes high
+		@input floor, now (default monotonic())
+		"""
+		self.lastFloor = floor
+		self.anchorPosition = float(floor)
+		self.anchorTime = monotonic() if now is None else now
+
+	def get_position(self, now=None):
+		"""
+		Returns the estimated fractional floor, or None until the first sensor edge
+		@input now (default monotonic())
+		@return position
+		"""
+		if self.anchorPosition is None:
+			return None
+		if now is None:
+			now = monotonic()
+		position = self.anchorPosition + self.velocity * (now - self.anchorTime)
+		# The car can't pass a floor without its sensor firing, so it stays within one floor of the last one
+		low = max(0, self.lastFloor - 1)
+		high = min(config.NUM_FLOORS - 1, self.lastFloor + 1)
+		return min(max(position, low), high)
+
+	def get_velocity(self):
+		"""
+		Returns the estimated velocity in floors per second, positive upwards
+		@return velocity
+		"""
+		return self.velocity
+
+	def seconds_to_floor(self, floor, now=None):
+		"""
+		Estimates when the car reaches a floor at its current velocity
+		@input floor, now (default monotonic())
+		@return seconds (None if the car is not heading towards the floor)
+		"""
+		position = self.get_position(now)
+		if position is None or self.velocity == 0:
+			return None
+		seconds = (floor - position) / self.velocity
+		return seconds if seconds >= 0 else None
@@ -6,14 +6,16 @@ from IO import io
 
 class SignalPoller(Thread):
 
-	def __init__(self, callbackQueue):
+	def __init__(self, loop):
 		"""
 		Initializing
 		"""
 		super(SignalPoller, self).__init__()
 		self.daemon = True
-		self.callbackQueue = callbackQueue
+		self.interrupt = False
+		self.loop = loop
 		self.callbacks = {}
+		self.analogCallbacks = {}
 		self.frequency = 100.0
 
 	def add_callback_to_channel(self, channel, callback):
@@ -23,14 +25,39 @@ class SignalPoller(Thread):
 		"""
 		self.callbacks[channel] = {'lastval': 0, 'callback': callback}
 
+	def add_callback_to_analog_channel(self, channel, callback, threshold=1):
+		""" 
+		Fires the callback with the new value when the value on an analog channel changes by threshold
+		@input channel, callback, threshold
+		"""
+		self.analogCallbacks[channel] = {'lastval': None, 'callback': callback, 'threshold': threshold}
+
+	def read_channel(self, channel):
+		"""
+		Reads a channel right away, for checks outside the polling
+		@input channel
+		@return value
+		"""
+		if channel == -1:
+			return 0
+		return io.read_bit(channel)
+
+	def stop(self):
+		""" Stops handing callbacks to the event loop """
+		self.interrupt = True
+
 	def run(self):
-		""" Run the poller until the main thread stops """
-		while True:
+		""" Run the poller until stopped, handing callbacks to the event loop """
+		while not self.interrupt:
 			sleep(1/self.frequency)
 			for channel in self.callbacks.keys():
 				if channel != -1:
 					value = io.read_bit(channel)
 					if value == 1 and value != self.callbacks[channel]['lastval']:
-						#self.callbacks[channel]['callback']()
-						self.callbackQueue.put(self.callbacks[channel]['callback'])
-					self.callbacks[channel]['lastval'] = value
\ No newline at end of file
+						self.loop.call_soon_threadsafe(self.callbacks[channel]['callback'])
+					self.callbacks[channel]['lastval'] = value
+			for channel, analog in self.analogCallbacks.items():
+				value = io.read_analog(channel)
+				if analog['lastval'] is None or abs(value - analog['lastval']) >= analog['threshold']:
+					self.loop.call_soon_threadsafe(analog['callback'], value)
+					analog['lastval'] = value
\ No newline at end of file
@@ -0,0 +1,80 @@
+from models import OrderQueue, Order, ORDERDIR
+from channels import OUTPUT
+from os.path import isfile
+import json
+import time
+import os
+import config
+
+
+class CarSnapshot:
+	"""
+	The state needed to resume without a homing run: last known floor, direction, door state
+	and inner orders, stamped with the wall clock time it was taken
+	"""
+	def __init__(self, floor=-1, direction=OUTPUT.MOTOR_DOWN, doorOpen=False, innerFloors=(), timestamp=0.0):
+		self.floor = floor
+		self.direction = direction
+		self.doorOpen = doorOpen
+		self.innerFloors = list(innerFloors)
+		self.timestamp = timestamp
+
+	def is_fresh(self, now=None):
+		"""
+		Returns if the snapshot is recent enough to resume from
+		@input now (default time.time())
+		@return true, false
+		"""
+		if now is None:
+			now = time.time()
+		return 0 <= self.floor < config.NUM_FLOORS and 0 <= now - self.timestamp <= config.SNAPSHOT_MAX_AGE_SECONDS
+
+	def get_order_queue(self):
+		"""
+		Returns an OrderQueue holding the inner orders of the snapshot
+		@return OrderQueue
+		"""
+		orderQueue = OrderQueue()
+		for floor in self.innerFloors:
+			orderQueue.add_order(Order(ORDERDIR.IN, floor))
+		return orderQueue
+
+	def serialize(self):
+		"""
+		Serializing itself
+		"""
+		return {'floor': self.floor, 'direction': self.direction, 'door': int(self.doorOpen), 'inner': self.innerFloors, 'time': self.timestamp}
+
+	@staticmethod
+	def deserialize(snapshot):
+		"""
+		Deserializing a snapshot
+		@input snapshot (serialized object)
+		@return CarSnapshot
+		"""
+		try:
+			return CarSnapshot(int(snapshot['floor']), int(snapshot['direction']), bool(snapshot['door']),
+				[int(floor) for floor in snapshot['inner'] if 0 <= int(floor) < config.NUM_FLOORS], float(snapshot['time']))
+		except (KeyError, TypeError, ValueError):
+			raise ValueError("WRONG SNAPSHOT")
+
+	def save_to_file(self):
+		"""
+		Writes the snapshot to a temporary file and renames it, so a crash never leaves half a file
+		"""
+		with open('car.snapshot.tmp', 'w') as wfile:
+			json.dump(self.serialize(), wfile)
+		os.rename('car.snapshot.tmp', 'car.snapshot')
+
+	@staticmethod
+	def load_from_file():
+		"""
+		Loading from file and returning a CarSnapshot (an empty, stale one if there is none)
+		"""
+		if not isfile('car.snapshot'):
+			return CarSnapshot()
+		try:
+			with open('car.snapshot', 'r') as rfile:
+				return CarSnapshot.deserialize(json.load(rfile))
+		except ValueError:
+			return CarSnapshot()
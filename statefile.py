@@ -0,0 +1,100 @@
+from snapshot import CarSnapshot
+from zlib import crc32
+import struct
+import mmap
+import os
+import config
+
+# Bytes of the inner orders, one bit per floor
+INNER_BYTES = (config.NUM_FLOORS + 7) // 8
+
+# Generation, floor, direction, door open, timestamp, inner orders as a bitset of floors
+SLOT = struct.Struct('<QhbBd%ds' % INNER_BYTES)
+CHECKSUM = struct.Struct('<I')
+SLOT_SIZE = SLOT.size + CHECKSUM.size
+
+# Every slot starts a page of its own, so a torn page write can only hit one of them
+SLOT_STRIDE = (SLOT_SIZE + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+
+
+class StateFile:
+	"""
+	Keeps the car snapshot, inner orders included, in a memory-mapped file with two slots.
+	Writes alternate between the slots, so the newest complete one survives a torn write,
+	and the file is synced to disk at most every STATEFILE_SYNC_SECONDS
+	"""
+	def __init__(self, loop, path='car.state'):
+		"""
+		@input loop (EventLoop running the syncs), path
+		"""
+		self.loop = loop
+		self.path = path
+		self.map = None
+		self.generation = 0
+		self.dirty = False
+		self.syncTimer = None
+
+	def read_slot(self, index):
+		"""
+		Reads a slot
+		@input index (0, 1)
+		@return (generation, CarSnapshot), None if the slot is empty or corrupt
+		"""
+		offset = index * SLOT_STRIDE
+		data = self.map[offset:offset + SLOT.size]
+		checksum, = CHECKSUM.unpack(self.map[offset + SLOT.size:offset + SLOT_SIZE])
+		if checksum != crc32(data) & 0xffffffff:
+			return None
+		generation, floor, direction, doorOpen, timestamp, inner = SLOT.unpack(data)
+		if generation == 0:
+			return None
+		inner = bytearray(inner)
+		innerFloors = [innerFloor for innerFloor in xrange(config.NUM_FLOORS) if inner[innerFloor >> 3] & (1 << (innerFloor & 7))]
+		return generation, CarSnapshot(floor, direction, bool(doorOpen), innerFloors, timestamp)
+
+	def recover(self):
+		"""
+		Maps the file, creating it if needed, and returns the snapshot in the newest valid slot.
+		Falls back to the snapshot file of the other backend when no slot is valid
+		@return CarSnapshot
+		"""
+		fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0644)
+		try:
+			if os.fstat(fd).st_size != 2 * SLOT_STRIDE:
+				os.ftruncate(fd, 2 * SLOT_STRIDE)
+			self.map = mmap.mmap(fd, 2 * SLOT_STRIDE)
+		finally:
+			os.close(fd)
+
+		slots = [slot for slot in (self.read_slot(0), self.read_slot(1)) if slot]
+		if not slots:
+			return CarSnapshot.load_from_file()
+		self.generation, snapshot = max(slots, key=lambda slot: slot[0])
+		return snapshot
+
+	def write(self, snapshot):
+		"""
+		Writes the snapshot to the slot not holding the newest one and schedules a sync
+		@input snapshot (CarSnapshot)
+		"""
+		self.generation += 1
+		inner = bytearray(INNER_BYTES)
+		for floor in snapshot.innerFloors:
+			inner[floor >> 3] |= 1 << (floor & 7)
+		data = SLOT.pack(self.generation, snapshot.floor, snapshot.direction, int(snapshot.doorOpen), snapshot.timestamp, str(inner))
+		offset = (self.generation % 2) * SLOT_STRIDE
+		self.map[offset:offset + SLOT_SIZE] = data + CHECKSUM.pack(crc32(data) & 0xffffffff)
+		self.dirty = True
+		if self.syncTimer is None:
+			self.syncTimer = self.loop.call_later(config.STATEFILE_SYNC_SECONDS, self.commit)
+
+	def commit(self):
+		"""
+		Syncs the written slots to disk on the executor
+		"""
+		if self.syncTimer is not None:
+			self.syncTimer.cancel()
+			self.syncTimer = None
+		if self.dirty:
+			self.dirty = False
+			self.loop.run_in_executor(self.map.flush)
@@ -0,0 +1,140 @@
+import math
+
+
+class TimerHandle:
+	"""
+	A callback scheduled on a TimerWheel, which can be cancelled until it runs
+	"""
+	def __init__(self, deadline, callback, args, sequence=0):
+		self.deadline = deadline
+		self.callback = callback
+		self.args = args
+		self.sequence = sequence
+		self.expiry = None
+		self.slot = None
+		self.cancelled = False
+
+	def cancel(self):
+		""" Prevents the callback from running and frees its slot at once """
+		self.cancelled = True
+		if self.slot is not None:
+			self.slot.discard(self)
+			self.slot = None
+
+
+class TimerWheel:
+	"""
+	Hierarchical timing wheel. Scheduling and cancelling are O(1) no matter how many timers
+	are pending; expiring walks the wheel one tick at a time and cascades timers from the
+	coarse levels down to the finest one as their time comes closer.
+	"""
+	def __init__(self, now, tick=0.001, slotBits=8, levels=4):
+		"""
+		Initializing empty wheels
+		@input now (monotonic time), tick (seconds), slotBits (2**slotBits slots per level), levels
+		"""
+		self.tick = tick
+		self.slotBits = slotBits
+		self.slotMask = (1 << slotBits) - 1
+		self.levels = levels
+		self.maxDelta = (1 << (slotBits*levels)) - 1
+		self.wheels = [[set() for _ in xrange(1 << slotBits)] for _ in xrange(levels)]
+		self.currentTick = int(now / tick)
+		self.overdue = set()
+
+	def schedule(self, handle):
+		"""
+		Puts a handle in the wheel, firing on the first tick at or after its deadline
+		@input handle (TimerHandle)
+		"""
+		handle.expiry = int(math.ceil(handle.deadline / self.tick))
+		if handle.expiry <= self.currentTick:
+			handle.slot = self.overdue
+			self.overdue.add(handle)
+		else:
+			self.place(handle)
+
+	def place(self, handle):
+		"""
+		Puts a handle in the level matching how far away it is
+		@input handle
+		"""
+		expiry = min(handle.expiry, self.currentTick + self.maxDelta)
+		delta = expiry - self.currentTick
+		for level in xrange(self.levels):
+			if delta >> (self.slotBits*(level+1)) == 0:
+				break
+		slot = self.wheels[level][(expiry >> (self.slotBits*level)) & self.slotMask]
+		slot.add(handle)
+		handle.slot = slot
+
+	def take(self, level, index):
+		"""
+		Empties a slot and returns what was in it
+		@input level, index
+		@return set of handles
+		"""
+		slot = self.wheels[level][index]
+		self.wheels[level][index] = set()
+		for handle in slot:
+			handle.slot = None
+		return slot
+
+	def advance(self, now):
+		"""
+		Walks the wheel up to now
+		@input now (monotonic time)
+		@return list of due handles, ordered by deadline
+		"""
+		due = list(self.take_overdue())
+		target = int(now / self.tick)
+		while self.currentTick < target:
+			self.currentTick += 1
+			for level in xrange(1, self.levels):
+				if self.currentTick & ((1 << (self.slotBits*level)) - 1):
+					break
+				for handle in self.take(level, (self.currentTick >> (self.slotBits*level)) & self.slotMask):
+					self.place(handle)
+			due.extend(self.take(0, self.currentTick & self.slotMask))
+		due.sort(key=lambda handle: (handle.deadline, handle.sequence))
+		return due
+
+	def take_overdue(self):
+		"""
+		Returns the handles scheduled after their tick had already passed
+		@return set of handles
+		"""
+		overdue = self.overdue
+		self.overdue = set()
+		for handle in overdue:
+			handle.slot = None
+		return overdue
+
+	def cancel_all(self):
+		""" Cancels every pending handle """
+		for wheel in self.wheels:
+			for slot in wheel:
+				for handle in list(slot):
+					handle.cancel()
+		for handle in list(self.overdue):
+			handle.cancel()
+
+	def next_deadline(self):
+		"""
+		Returns when the loop has to wake up for the wheel: the earliest of the tick of the nearest timer
+		in the finest level and the next cascade of each coarser level
+		@return monotonic time (None if no timers are pending)
+		"""
+		if self.overdue:
+			return self.currentTick * self.tick
+		nearest = None
+		for level in xrange(self.levels):
+			shift = self.slotBits*level
+			position = self.currentTick >> shift
+			for step in xrange(1, self.slotMask + 2):
+				if self.wheels[level][(position + step) & self.slotMask]:
+					tick = (position + step) << shift
+					if nearest is None or tick < nearest:
+						nearest = tick
+					break
+		return None if nearest is None else nearest * self.tick
@@ -0,0 +1,167 @@
+from os.path import isfile
+import os
+import json
+import config
+
+# Weight of a new sample in the exponentially weighted averages
+ALPHA = 0.2
+
+# Samples this many times longer than the current estimate are ignored (stop button, obstruction)
+OUTLIER_FACTOR = 4.0
+
+
+class TravelModel:
+	"""
+	Learns how long the car takes to travel each floor segment and how long the door
+	stays open in each floor, as exponentially weighted averages of sensor timestamps
+	"""
+	def __init__(self, segmentSeconds=None, dwellSeconds=None, boardingSeconds=None):
+		"""
+		Initializing with the configured defaults where nothing is learned yet
+		@input segmentSeconds (seconds between floor i and i+1), dwellSeconds (seconds per floor),
+		boardingSeconds (seconds from opening the door until the last passenger is in, per floor)
+		"""
+		self.segmentSeconds = segmentSeconds or [float(config.FLOOR_TRAVEL_SECONDS)] * (config.NUM_FLOORS - 1)
+		self.dwellSeconds = dwellSeconds or [float(config.DOOR_OPEN_SECONDS)] * config.NUM_FLOORS
+		self.boardingSeconds = boardingSeconds or [float(config.DOOR_CAR_CALL_SECONDS)] * config.NUM_FLOORS
+		self.lastEdge = None
+		self.doorOpened = None
+		self.lastActivity = None
+
+	def learn(self, values, index, sample):
+		"""
+		Folds a sample into the average at values[index]
+		@input values, index, sample
+		"""
+		if sample <= 0 or sample > values[index] * OUTLIER_FACTOR:
+			return
+		values[index] += ALPHA * (sample - values[index])
+
+	def motor_started(self, floor, now):
+		"""
+		Starts timing a segment if the car leaves a known floor
+		@input floor, now
+		"""
+		self.lastEdge = (floor, now) if floor >= 0 else None
+
+	def motor_stopped(self):
+		"""
+		A stop between two sensor edges makes the segment useless
+		"""
+		self.lastEdge = None
+
+	def sensor_edge(self, floor, now):
+		"""
+		Learns the segment between the last edge and this one
+		@input floor, now
+		"""
+		if self.lastEdge is not None:
+			lastFloor, lastTime = self.lastEdge
+			if abs(floor - lastFloor) == 1:
+				self.learn(self.segmentSeconds, min(floor, lastFloor), now - lastTime)
+		self.lastEdge = (floor, now)
+
+	def door_opened(self, floor, now):
+		"""
+		Starts timing the dwell in a floor
+		@input floor, now
+		"""
+		if self.doorOpened is not None and self.doorOpened[0] == floor:
+			# Reopened before closing, keep timing from the first opening
+			return
+		self.doorOpened = (floor, now) if floor >= 0 else None
+		self.lastActivity = None
+
+	def passenger_activity(self, now):
+		"""
+		Records a car button or obstruction while the door is open
+		@input now
+		"""
+		self.lastActivity = now
+
+	def door_closed(self, now):
+		"""
+		Learns the dwell of the floor the door was opened in from when the door was free: the last car button
+		or obstruction, or DOOR_MIN_SECONDS after opening if there was none. The time the door was held open
+		is chosen by the elevator itself, so learning from it would only learn the choice back
+		@input now
+		"""
+		if self.doorOpened is not None:
+			floor, openedTime = self.doorOpened
+			freeSeconds = config.DOOR_MIN_SECONDS
+			if self.lastActivity is not None:
+				freeSeconds = max(freeSeconds, self.lastActivity - openedTime)
+				self.learn(self.boardingSeconds, floor, self.lastActivity - openedTime)
+			self.learn(self.dwellSeconds, floor, min(freeSeconds, now - openedTime))
+		self.doorOpened = None
+		self.lastActivity = None
+
+	def travel_seconds(self, position, floor):
+		"""
+		Predicts the travel time from a (fractional) position to a floor without stopping
+		@input position, floor
+		@return seconds
+		"""
+		low, high = sorted((position, floor))
+		seconds = 0.0
+		for segment in xrange(int(low), min(int(high) + 1, len(self.segmentSeconds))):
+			overlap = min(high, segment + 1) - max(low, segment)
+			if overlap > 0:
+				seconds += overlap * self.segmentSeconds[segment]
+		return seconds
+
+	def predict_arrival(self, position, floor, stops=()):
+		"""
+		Predicts the time until the car arrives in a floor when it stops in some floors on the way
+		@input position, floor, stops (floors to stop in first)
+		@return seconds
+		"""
+		return self.travel_seconds(position, floor) + sum(self.dwellSeconds[stop] for stop in set(stops))
+
+	def serialize(self):
+		"""
+		Serializing itself compactly
+		"""
+		return {
+			'segments': [round(s, 2) for s in self.segmentSeconds],
+			'dwell': [round(d, 2) for d in self.dwellSeconds],
+			'boarding': [round(b, 2) for b in self.boardingSeconds]
+			}
+
+	@staticmethod
+	def deserialize(model):
+		"""
+		Deserializing a travelmodel
+		@input model (serialized object)
+		@return TravelModel
+		"""
+		try:
+			segmentSeconds = [float(s) for s in model['segments']]
+			dwellSeconds = [float(d) for d in model['dwell']]
+			boardingSeconds = [float(b) for b in model.get('boarding', dwellSeconds)]
+		except (KeyError, TypeError, ValueError, AttributeError):
+			raise ValueError("WRONG TRAVELMODEL")
+		if len(segmentSeconds) != config.NUM_FLOORS - 1 or len(dwellSeconds) != config.NUM_FLOORS or len(boardingSeconds) != config.NUM_FLOORS:
+			raise ValueError("WRONG TRAVELMODEL")
+		return TravelModel(segmentSeconds, dwellSeconds, boardingSeconds)
+
+	def save_to_file(self):
+		"""
+		Writes the model to a temporary file and renames it, so a crash never leaves half a file
+		"""
+		with open('travelmodel.backup.tmp', 'w') as wfile:
+			json.dump(self.serialize(), wfile)
+		os.rename('travelmodel.backup.tmp', 'travelmodel.backup')
+
+	@staticmethod
+	def load_from_file():
+		"""
+		Loading from file and returning a TravelModel
+		"""
+		if not isfile('travelmodel.backup'):
+			return TravelModel()
+		try:
+			with open('travelmodel.backup', 'r') as rfile:
+				return TravelModel.deserialize(json.load(rfile))
+		except ValueError:
+			return TravelModel()
@@ -0,0 +1,240 @@
+"""
+Binary heartbeat format. A datagram is a header (protocol version, flags, node id, sequence number,
+state version) followed by the state of the elevator, with the order sets packed as one bit per floor,
+and the new and started orders. Keepalives leave out the state, which the receivers already have in
+the state version of the header, and resync requests only carry the node id they are meant for.
+The travel model grows with the floors and rarely changes, so it is sent in datagrams of its own.
+Heartbeats starting with '{' are JSON, the debug format, and both decode to the same message dict.
+"""
+from binascii import hexlify, unhexlify
+import struct
+import json
+from models import ORDERDIR
+import config
+
+PROTOCOL_VERSION = 2
+
+class FLAG:
+	LEAVING = 0x01
+	KEEPALIVE = 0x02
+	RESYNC = 0x04
+	TRAVELMODEL = 0x08
+
+HEADER = struct.Struct('!BBIII')
+
+# Bytes in an order set, one bit per floor
+ORDERSET_BYTES = (config.NUM_FLOORS + 7) // 8
+
+# Direction, current floor, position (hundredths of a floor), velocity (thousandths of a floor a second),
+# parking floor, load (hundredths), oldest wait (seconds, so waiting orders do not change the state every
+# heartbeat), dispatch mode, dispatch mode version and the up, down and inner order sets, all packed in one go
+STATE = struct.Struct('!BhhhhBHBd' + ('%ds' % ORDERSET_BYTES) * 3)
+
+# The travel model segments, dwells and boarding times (hundredths of a second)
+TRAVELMODEL = struct.Struct('!%dH' % (3 * config.NUM_FLOORS - 1))
+
+# Stands for an unknown position
+NO_POSITION = -0x8000
+
+COUNT = struct.Struct('!B')
+DESTINATION = struct.Struct('!HH')
+ORDER_ID = struct.Struct('!I')
+NODE = struct.Struct('!I')
+
+# The keys of a message that keepalives carry as well
+KEEPALIVE_KEYS = ('newOrders', 'startedOrders', 'leaving')
+
+# Size of the receive buffer, the largest UDP payload, so the receivers never cut a datagram short
+RECV_BYTES = 65507
+
+if config.MAX_DATAGRAM_BYTES > RECV_BYTES:
+	raise ValueError("MAX_DATAGRAM_BYTES LARGER THAN THE RECEIVE BUFFER")
+
+# Most destinations in a state, so the state and the order counts always fit in MAX_DATAGRAM_BYTES
+MAX_DESTINATIONS = min(0xff, (config.MAX_DATAGRAM_BYTES - HEADER.size - STATE.size - 3 * COUNT.size) // DESTINATION.size)
+
+if MAX_DESTINATIONS < 0 or HEADER.size + TRAVELMODEL.size > config.MAX_DATAGRAM_BYTES:
+	raise ValueError("NUM_FLOORS TOO LARGE FOR MAX_DATAGRAM_BYTES")
+
+
+def pack_floors(floors):
+	"""
+	Packs floors into an order set
+	@input floors
+	@return bytes
+	"""
+	mask = 0
+	for floor in floors:
+		mask |= 1 << floor
+	return unhexlify('%0*x' % (2 * ORDERSET_BYTES, mask))
+
+
+def unpack_floors(data):
+	"""
+	Unpacks an order set
+	@input data (ORDERSET_BYTES bytes)
+	@return sorted list of floors
+	"""
+	mask = int(hexlify(data), 16)
+	floors = []
+	while mask:
+		bit = mask & -mask
+		floors.append(bit.bit_length() - 1)
+		mask ^= bit
+	return floors
+
+
+def clamp(value, low, high):
+	return max(low, min(high, int(round(value))))
+
+
+def encode_state(message):
+	"""
+	Encodes the state of the elevator, the part of a heartbeat that keepalives leave out.
+	Equal states encode to equal bytes, so the sender also uses it to see if the state changed
+	@input message (dict built by NetworkSender)
+	@return bytes
+	"""
+	position = message['position']
+	mode, modeVersion = message['mode']
+	orderQueue = message['orderQueue']
+	destinations = message['destinations'][:MAX_DESTINATIONS]
+	return ''.join([
+		STATE.pack(
+			message['direction'],
+			message['currentFloor'],
+			NO_POSITION if position is None else clamp(position * 100, -0x7fff, 0x7fff),
+			clamp(message['velocity'] * 1000, -0x8000, 0x7fff),
+			message['parking'],
+			clamp(message['load'] * 100, 0, 0xff),
+			clamp(message['oldestWait'], 0, 0xffff),
+			mode,
+			modeVersion,
+			pack_floors(orderQueue[ORDERDIR.UP]),
+			pack_floors(orderQueue[ORDERDIR.DOWN]),
+			pack_floors(orderQueue[ORDERDIR.IN])),
+		COUNT.pack(len(destinations))
+		] + [DESTINATION.pack(floor, destination) for floor, destination in destinations])
+
+
+def encode(message, nodeId, sequence, stateVersion, state=None, debug=False):
+	"""
+	Encodes a heartbeat
+	@input message (dict built by NetworkSender), nodeId, sequence, stateVersion,
+	state (encode_state of the message, None for a keepalive), debug (JSON instead of binary)
+	@return datagram
+	"""
+	if debug:
+		if state is None:
+			fields = dict((key, message[key]) for key in KEEPALIVE_KEYS if key in message)
+			fields['keepalive'] = True
+		else:
+			fields = dict(message)
+		fields.update(node=nodeId, seq=sequence, stateVersion=stateVersion)
+		return json.dumps(fields)
+	flags, payload = encode_payload(message, state)
+	return encode_header(flags, nodeId, sequence, stateVersion) + payload
+
+
+def encode_payload(message, state=None):
+	"""
+	Encodes the part of a binary heartbeat after the header, which stays the same from one heartbeat
+	to the next as long as the state and the new and started orders do
+	@input message (dict built by NetworkSender), state (encode_state of the message, None for a keepalive)
+	@return (flags, payload)
+	"""
+	flags = FLAG.LEAVING if message.get('leaving') else 0
+	if state is None:
+		flags |= FLAG.KEEPALIVE
+	parts = [state or '']
+	for key in ('newOrders', 'startedOrders'):
+		orders = message[key][:0xff]
+		parts.append(COUNT.pack(len(orders)))
+		parts.extend(ORDER_ID.pack(order) for order in orders)
+	return flags, ''.join(parts)
+
+
+def encode_header(flags, nodeId, sequence, stateVersion):
+	"""
+	Encodes the header of a binary heartbeat
+	@input flags, nodeId, sequence, stateVersion
+	@return bytes
+	"""
+	return HEADER.pack(PROTOCOL_VERSION, flags, nodeId, sequence & 0xffffffff, stateVersion & 0xffffffff)
+
+
+def encode_travel_model(travelModel):
+	"""
+	Encodes the travel model. Equal models encode to equal bytes, so the sender also uses it to see if the model changed
+	@input travelModel (serialized TravelModel)
+	@return bytes
+	"""
+	return TRAVELMODEL.pack(*[min(0xffff, int(seconds * 100 + 0.5)) for seconds in travelModel['segments'] + travelModel['dwell'] + travelModel['boarding']])
+
+
+def encode_resync(nodeId, sequence, target, debug=False):
+	"""
+	Encodes a request for the full state of another node
+	@input nodeId, sequence, target (node id), debug (JSON instead of binary)
+	@return datagram
+	"""
+	if debug:
+		return json.dumps({'node': nodeId, 'seq': sequence, 'resync': target})
+	return HEADER.pack(PROTOCOL_VERSION, FLAG.RESYNC, nodeId, sequence & 0xffffffff, 0) + NODE.pack(target)
+
+
+def decode(data):
+	"""
+	Decodes a datagram in either format
+	@input data (datagram, a string or a memoryview of a receive buffer)
+	@return message dict, with the node id, sequence number and state version under 'node', 'seq' and 'stateVersion'.
+	Keepalives have 'keepalive' set and only the KEEPALIVE_KEYS, resync requests only have 'resync', the target node id,
+	and travel model datagrams have 'travel' set and only the 'travelModel'
+	"""
+	if len(data) and data[0] == '{':
+		return json.loads(data.tobytes() if isinstance(data, memoryview) else data)
+	try:
+		version, flags, nodeId, sequence, stateVersion = HEADER.unpack_from(data)
+		if version != PROTOCOL_VERSION:
+			raise ValueError("WRONG PROTOCOL VERSION")
+		offset = HEADER.size
+		if flags & FLAG.RESYNC:
+			return {'node': nodeId, 'seq': sequence, 'resync': NODE.unpack_from(data, offset)[0]}
+		if flags & FLAG.TRAVELMODEL:
+			times = [value / 100.0 for value in TRAVELMODEL.unpack_from(data, offset)]
+			segments = config.NUM_FLOORS - 1
+			return {'node': nodeId, 'seq': sequence, 'stateVersion': stateVersion, 'travel': True,
+				'travelModel': {'segments': times[:segments], 'dwell': times[segments:segments + config.NUM_FLOORS], 'boarding': times[segments + config.NUM_FLOORS:]}}
+		if flags & FLAG.KEEPALIVE:
+			message = {'node': nodeId, 'seq': sequence, 'stateVersion': stateVersion, 'keepalive': True}
+		else:
+			direction, currentFloor, position, velocity, parking, load, oldestWait, mode, modeVersion, up, down, inner = STATE.unpack_from(data, offset)
+			offset += STATE.size
+			message = {
+				'node': nodeId,
+				'seq': sequence,
+				'stateVersion': stateVersion,
+				'direction': direction,
+				'currentFloor': currentFloor,
+				'position': None if position == NO_POSITION else position / 100.0,
+				'velocity': velocity / 1000.0,
+				'parking': parking,
+				'load': load / 100.0,
+				'oldestWait': float(oldestWait),
+				'mode': [mode, modeVersion],
+				'orderQueue': {ORDERDIR.UP: unpack_floors(up), ORDERDIR.DOWN: unpack_floors(down), ORDERDIR.IN: unpack_floors(inner)}
+				}
+			count, = COUNT.unpack_from(data, offset)
+			offset += COUNT.size
+			message['destinations'] = [list(DESTINATION.unpack_from(data, offset + i * DESTINATION.size)) for i in xrange(count)]
+			offset += count * DESTINATION.size
+		for key in ('newOrders', 'startedOrders'):
+			count, = COUNT.unpack_from(data, offset)
+			offset += COUNT.size
+			message[key] = [ORDER_ID.unpack_from(data, offset + i * ORDER_ID.size)[0] for i in xrange(count)]
+			offset += count * ORDER_ID.size
+	except struct.error:
+		raise ValueError("WRONG MESSAGE")
+	if flags & FLAG.LEAVING:
+		message['leaving'] = True
+	return message
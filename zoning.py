@@ -0,0 +1,80 @@
+import time
+import config
+
+
+class DISPATCHMODE:
+	NORMAL = 0
+	ZONING = 1
+	UPPEAK = 2
+	NAMES = {NORMAL: 'NORMAL', ZONING: 'ZONING', UPPEAK: 'UPPEAK'}
+
+
+class DispatchMode:
+	"""
+	The dispatch mode of the whole bank. Every elevator broadcasts its mode with the time it was set,
+	and the newest setting wins, so switching the mode on one elevator switches all of them.
+	"""
+	def __init__(self, mode=config.DISPATCH_MODE):
+		self.mode = mode
+		self.version = 0.0
+
+	def set_mode(self, mode):
+		"""
+		Switches the mode at runtime
+		@input mode (DISPATCHMODE)
+		"""
+		self.mode = mode
+		self.version = time.time()
+
+	def merge(self, serialized):
+		"""
+		Adopts the mode of another elevator if it was set later
+		@input serialized ([mode, version])
+		@return true if the mode changed
+		"""
+		mode, version = serialized
+		if version <= self.version:
+			return False
+		changed = mode != self.mode
+		self.mode = mode
+		self.version = version
+		return changed
+
+	def serialize(self):
+		"""
+		Serializing itself
+		"""
+		return [self.mode, self.version]
+
+	def is_zoned(self):
+		"""
+		Returns if the elevators only take hall calls in their own zone
+		@return true, false
+		"""
+		return self.mode in (DISPATCHMODE.ZONING, DISPATCHMODE.UPPEAK)
+
+
+def get_zones(ips):
+	"""
+	Splits the floors above the lobby into one contiguous zone per elevator, the lowest zone going
+	to the lowest ip. Every zone includes the lobby, so the elevators serving high zones run express
+	past the low ones. If there are more elevators than floors, the rest serve the whole building.
+	@input ips
+	@return dict of ip: (lowest floor, highest floor) above the lobby
+	"""
+	ips = sorted(ips)
+	floors = [floor for floor in xrange(config.NUM_FLOORS) if floor != config.LOBBY_FLOOR]
+	zones = {}
+	for i, ip in enumerate(ips):
+		zone = floors[i*len(floors)//len(ips):(i+1)*len(floors)//len(ips)]
+		zones[ip] = (zone[0], zone[-1]) if zone else (0, config.NUM_FLOORS - 1)
+	return zones
+
+
+def in_zone(zone, floor):
+	"""
+	Returns if an elevator with the zone serves hall calls in the floor
+	@input zone, floor
+	@return true, false
+	"""
+	return floor == config.LOBBY_FLOOR or zone[0] <= floor <= zone[1]